@@ -4,11 +4,57 @@ __author__      = "Brian Allen Vanderburg II"
 __copyright__   = "Copyright 2016"
 __license__     = "Apache License 2.0"
 
+import sys
+import importlib
+
 from .errors import *
-from .renderers import *
-from .env import Environment
-from .loaders import *
-from .template import Template
-from .lib import Library, StdLib
+from . import errors as _errors
+
+
+# The rest of the public API is imported from its module on first use
+_lazy = {
+    "Renderer": ".renderers",
+    "StreamRenderer": ".renderers",
+    "StringRenderer": ".renderers",
+    "BytesRenderer": ".renderers",
+    "SafeString": ".markup",
+    "escape": ".markup",
+    "Environment": ".env",
+    "LazyValue": ".scope",
+    "Loader": ".loaders",
+    "UnrestrictedLoader": ".loaders",
+    "SearchPathLoader": ".loaders",
+    "MemoryLoader": ".loaders",
+    "Template": ".template",
+    "Library": ".lib",
+    "StdLib": ".lib",
+    "precompile": ".precompile",
+    "save_code_cache": ".codecache",
+    "load_code_cache": ".codecache",
+    "IncrementalRender": ".incremental",
+    "Metrics": ".metrics"
+}
+
+__all__ = [name for name in vars(_errors) if not name.startswith("_")] + list(_lazy)
+
+
+def __getattr__(name):
+    """ Import a public name when it is first used. """
+    module = _lazy.get(name)
+    if module is None:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    """ Include the names not imported yet. """
+    return sorted(set(globals()) | set(_lazy))
 
 
+if sys.version_info < (3, 7):
+    # Module __getattr__ is not supported
+    for _name in _lazy:
+        __getattr__(_name)
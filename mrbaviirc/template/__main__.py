@@ -18,11 +18,27 @@ if __name__ == "__main__":
         parser = argparse.ArgumentParser(description="Template Test")
         parser.add_argument("-c", dest="count", default=1, help="Render the template this many times")
         parser.add_argument("-p", dest="show", default=None, action="store_true", help="Print sections.")
-        parser.add_argument("template", help="Location of the template")
+        parser.add_argument("-j", dest="workers", default=None, type=int, help="Number of precompile workers")
+        parser.add_argument("--precompile", dest="precompile", default=None, nargs="+", metavar="PATH",
+                            help="Parse all templates along the search paths and report errors")
+        parser.add_argument("template", nargs="?", help="Location of the template")
         parser.add_argument("data", nargs="?", help="Location of the data json")
 
         args = parser.parse_args()
 
+        if args.precompile:
+            try:
+                names = precompile(args.precompile, args.workers)
+            except PrecompileError as e:
+                for error in e.errors:
+                    print("{0}: {1}".format(type(error).__name__, error.message))
+                sys.exit(1)
+
+            print("{0} templates ok".format(len(names)))
+            sys.exit(0)
+
+        if not args.template:
+            parser.error("a template is required")
 
         e = Environment({"lib": StdLib()})
         t = e.load_file(args.template)
@@ -0,0 +1,158 @@
+""" Compile and cache the python code of code tags. """
+
+__author__      = "Brian Allen Vanderburg II"
+__copyright__   = "Copyright 2016"
+__license__     = "Apache License 2.0"
+
+__all__ = ["save_code_cache", "load_code_cache"]
+
+import ast
+import hashlib
+import marshal
+import types
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+
+# Compiled code keyed by a hash of the parameters and source, shared by all
+# templates.  Saved files start with the bytecode magic number of the Python
+# version that wrote them.
+_cache = {}
+
+try:
+    from importlib.util import MAGIC_NUMBER as _MAGIC
+except ImportError:
+    from imp import get_magic # Python 2
+    _MAGIC = get_magic()
+
+_FUNCTION = "_template_code"
+
+# Nodes starting a nested scope, and nodes that act differently in a function
+_SCOPES = tuple(
+    getattr(ast, name) for name in ("FunctionDef", "AsyncFunctionDef", "ClassDef", "Lambda")
+    if hasattr(ast, name)
+)
+_FUNCTION_ONLY = tuple(
+    getattr(ast, name) for name in ("Return", "Yield", "YieldFrom", "Await")
+    if hasattr(ast, name)
+)
+_BUILTINS = frozenset(dir(builtins))
+
+
+def compile_code(source, params):
+    """ Return the code of a function taking the parameters, running the
+        source, and returning its local variables.  Source that only works at
+        module level is compiled as a module instead.
+    """
+    key = "\0".join(params + ("", source))
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8") # Byte strings on Python 2 are hashed as is
+    key = hashlib.sha1(key).hexdigest()
+
+    code = _cache.get(key)
+    if code is None:
+        code = _cache[key] = _compile(source, params)
+
+    return code
+
+
+def code_function(code, params):
+    """ Return a function running compiled code with the given parameters
+        and returning its local variables.
+    """
+    if code.co_name == _FUNCTION:
+        return types.FunctionType(code, {"__builtins__": builtins})
+
+    def run(*args):
+        locals = dict(zip(params, args))
+        exec(code, locals, locals)
+        return locals
+
+    return run
+
+
+def _compile(source, params):
+    """ Compile the source into the body of a function, or as a module if it
+        would act differently in a function.
+    """
+    tree = ast.parse(source, "<string>", "exec")
+    if _module_only(tree):
+        return compile(tree, "<string>", "exec")
+
+    wrapper = ast.parse("def {0}({1}):\n    return locals()\n".format(
+        _FUNCTION,
+        ", ".join(params)
+    ))
+    wrapper.body[0].body[0:0] = tree.body
+
+    module = compile(wrapper, "<string>", "exec")
+    for const in module.co_consts:
+        if getattr(const, "co_name", None) == _FUNCTION:
+            return const
+
+
+def _module_only(tree):
+    """ Return whether code must run at module level to act as before. """
+
+    # "global" and "from ... import *" act on the module
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Global) or (
+            isinstance(node, ast.ImportFrom) and
+            any(alias.name == "*" for alias in node.names)
+        ):
+            return True
+
+    # "return" and "yield" are errors at module level.  Assigning a builtin
+    # name makes earlier uses of the builtin fail in a function.
+    pending = list(ast.iter_child_nodes(tree))
+    while pending:
+        node = pending.pop()
+        if isinstance(node, _FUNCTION_ONLY):
+            return True
+        if _assigned(node) & _BUILTINS:
+            return True
+        if not isinstance(node, _SCOPES):
+            pending.extend(ast.iter_child_nodes(node))
+
+    return False
+
+
+def _assigned(node):
+    """ Return the names a node assigns in its scope. """
+    if isinstance(node, ast.Name):
+        return set() if isinstance(node.ctx, ast.Load) else set([node.id])
+
+    if isinstance(node, _SCOPES) and not isinstance(node, ast.Lambda):
+        return set([node.name])
+
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return set(alias.asname or alias.name.split(".")[0] for alias in node.names)
+
+    if isinstance(node, ast.ExceptHandler) and isinstance(node.name, str):
+        return set([node.name])
+
+    return set()
+
+
+def save_code_cache(filename):
+    """ Save the compiled code of all code tags used so far to a file. """
+    with open(filename, "wb") as handle:
+        handle.write(_MAGIC)
+        marshal.dump(_cache, handle)
+
+
+def load_code_cache(filename):
+    """ Load compiled code saved by save_code_cache.  Return False without
+        loading anything if the file was written by a different Python
+        version.
+    """
+    with open(filename, "rb") as handle:
+        if handle.read(len(_MAGIC)) != _MAGIC:
+            return False
+
+        _cache.update(marshal.load(handle))
+
+    return True
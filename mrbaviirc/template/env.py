@@ -5,12 +5,84 @@ __copyright__   = "Copyright 2016"
 __license__     = "Apache License 2.0"
 
 
-from .template import Template
-from .scope import Scope
+import gc
+import copy
+import importlib
+
+try:
+    from collections import ChainMap
+except ImportError:
+    from collections import MutableMapping
+
+    class ChainMap(MutableMapping):
+        """ A mapping reading from several mappings and writing to the first,
+            for Python 2.
+        """
+
+        def __init__(self, *maps):
+            self.maps = list(maps)
+
+        def __getitem__(self, key):
+            for mapping in self.maps:
+                if key in mapping:
+                    return mapping[key]
+            raise KeyError(key)
+
+        def __contains__(self, key):
+            return any(key in mapping for mapping in self.maps)
+
+        def __setitem__(self, key, value):
+            self.maps[0][key] = value
+
+        def __delitem__(self, key):
+            del self.maps[0][key]
+
+        def __iter__(self):
+            return iter(set().union(*self.maps))
+
+        def __len__(self):
+            return len(set().union(*self.maps))
+
+        def pop(self, key, *default):
+            return self.maps[0].pop(key, *default)
+
+        def clear(self):
+            self.maps[0].clear()
+
+from .scope import Scope, LazyValue
 from .loaders import UnrestrictedLoader
 from .errors import *
+from .metrics import Metrics
+
+_BY_IDENTITY = object()
+
+# Importers can be given as "module:attribute" strings, imported when needed
+_DEFAULT_IMPORTERS = {
+    "mrbaviirc.template.stdlib": "mrbaviirc.template.lib.stdlib:StdLib",
+    "mrbaviirc.template.collection": "mrbaviirc.template.lib.collection:CollectionLib"
+}
+
+# Libraries created by string and class importers, shared by all environments
+_libraries = {}
+
+
+def _shared_library(importer):
+    """ Return the library created by a string or class importer, creating it
+        only once.
+    """
+    library = _libraries.get(importer)
+    if library is None:
+        factory = importer
+        if isinstance(importer, str):
+            (module, sep, attr) = importer.partition(":")
+            if not sep:
+                (module, sep, attr) = importer.rpartition(".")
+            factory = getattr(importlib.import_module(module), attr)
+
+        library = _libraries.setdefault(importer, factory())
+
+    return library
 
-from .lib import StdLib
 
 class Environment(object):
     """ represent a template environment. """
@@ -18,11 +90,20 @@ class Environment(object):
     def __init__(self, context=None, loader=None, importers=None):
         """ Initialize the template environment. """
 
+        self._base = self
         self._scope = Scope()
         self._scope_stack = [self._scope]
-        self._importers = { "mrbaviirc.template.stdlib": StdLib }
-        self._imported = {}
+        self._importers = _DEFAULT_IMPORTERS
         self._code_enabled = False
+        self._iterative = False
+        self._autoescape = False
+        self._memo = None
+        self._memo_hits = 0
+        self._memo_misses = 0
+        self._metrics = Metrics()
+        self._depth = 0 # Templates being rendered, for the metrics
+        self._imported = {} # Libraries of other importers, shared with forks
+        self._recorder = None # Notified of reads and writes, if set
 
         if context:
             self._scope._local.update(context)
@@ -33,15 +114,128 @@ class Environment(object):
             self._loader = UnrestrictedLoader()
 
         if importers:
+            self._importers = dict(_DEFAULT_IMPORTERS)
             self._importers.update(importers)
 
+    def metrics(self):
+        """ Return the metrics of rendering templates.  Forks of the
+            environment share the metrics.
+        """
+        return self._metrics
+
     def enable_code(self, enabled=True):
         """ Enable use of the code tag in templates. """
         self._code_enabled = enabled
 
+    def enable_iterative(self, enabled=True):
+        """ Render nested nodes and includes with an explicit stack instead
+            of recursion, so deeply nested or recursive includes are not
+            limited by the Python recursion limit.
+        """
+        self._iterative = enabled
+
+    def enable_autoescape(self, enabled=True):
+        """ Escape emitted values for HTML in templates loaded afterwards. """
+        self._autoescape = enabled
+
+    def enable_memoize(self, enabled=True):
+        """ Enable memoizing calls to library functions marked with memoize.
+            Results are kept only until the top-level render completes.
+        """
+        self._memo = {} if enabled else None
+
+    def memoize_stats(self):
+        """ Return the memoization hits and misses so far. """
+        return {
+            "hits": self._memo_hits,
+            "misses": self._memo_misses
+        }
+
+    def _call_memoized(self, fn, params):
+        """ Call a function, reusing a previous result if possible. """
+        memo = self._memo
+        params = tuple(params)
+
+        try:
+            key = (fn, params, tuple(type(param) for param in params))
+            entry = memo.get(key)
+        except TypeError:
+            # Unhashable arguments are matched by identity.  The arguments are
+            # kept in the entry so the ids remain valid during the render.
+            key = (fn, _BY_IDENTITY, tuple(id(param) for param in params))
+            entry = memo.get(key)
+
+        if entry is not None:
+            self._memo_hits += 1
+            return entry[0]
+
+        self._memo_misses += 1
+        value = fn(*params)
+        memo[key] = (value, params)
+        return value
+
+    def fork(self, context=None):
+        """ Return a light copy of the environment, such as for one request.
+
+            The fork shares the loader, loaded templates and imported libraries
+            with this environment.  Its global scope is a layer on top of this
+            environment's global scope, so values set by the fork, including
+            the given context, are not seen by this environment or other forks.
+            Values are not copied, so changes made to mutable values in place
+            are still shared.
+        """
+        env = copy.copy(self)
+        env._scope = Scope(local=ChainMap(dict(context or {}), self._scope_stack[0]._local))
+        env._scope_stack = [env._scope]
+        env._memo = {} if self._memo is not None else None
+        env._memo_hits = 0
+        env._memo_misses = 0
+        env._recorder = None
+        env._depth = 0
+
+        return env
+
     def load_file(self, filename, parent=None):
         """ Load a template from a file. """
-        return self._loader.load_template(self, filename, parent)
+        template = self._load(filename, parent)
+        if not template._env is self:
+            template = template._bind(self)
+
+        return template
+
+    def _load(self, filename, parent=None):
+        """ Load a template shared by this environment and its forks. """
+        return self._loader.load_template(self._base, filename, parent)
+
+    def preload(self, filenames, freeze=False):
+        """ Load templates and every template they include by a literal name.
+
+            This is intended to be called before forking worker processes so
+            the parsed templates are shared instead of being loaded lazily by
+            each worker.  If freeze is set, the garbage collector is frozen
+            afterward (where supported) so the loaded objects are not touched
+            by later collections.  Return the list of loaded templates.
+        """
+
+        pending = [(filename, None) for filename in reversed(filenames)]
+        loaded = []
+        seen = set()
+
+        while pending:
+            (filename, parent) = pending.pop()
+            template = self._load(filename, parent)
+            if id(template) in seen:
+                continue
+
+            seen.add(id(template))
+            loaded.append(template)
+            pending.extend((include, template) for include in reversed(template._includes()))
+
+        if freeze and hasattr(gc, "freeze"):
+            gc.collect()
+            gc.freeze()
+
+        return loaded
 
     def _push_scope(self, template=False):
         """ Create a new scope. """
@@ -57,6 +251,9 @@ class Environment(object):
 
     def set(self, name, value, where=Scope.SCOPE_LOCAL):
         """ Set a value in the a scope. """
+        if self._recorder is not None:
+            self._recorder.set(self, name, value, where)
+
         if where == Scope.SCOPE_LOCAL:
             self._scope._local[name] = value
         elif where == Scope.SCOPE_GLOBAL:
@@ -71,20 +268,31 @@ class Environment(object):
 
     def update(self, values):
         """ Update values in the context. """
+        if self._recorder is not None:
+            self._recorder.update(self, values)
+
         self._scope._local.update(values)
 
     def unset(self, name):
         """ Unset a variable from the current scope. """
+        if self._recorder is not None:
+            self._recorder.unset(self, name)
+
         self._scope._local.pop(name, None)
         self._scope._private.pop(name, None)
 
     def clear(self):
         """ Clear the current context. """
+        if self._recorder is not None:
+            self._recorder.clear(self)
+
         self._scope._local.clear()
         self._scope._private.clear()
 
     def get(self, var):
         """ Get a dotted variable. """
+        if self._recorder is not None:
+            self._recorder.get(self, var)
 
         # Find the scope dict it is in
         first = True
@@ -102,8 +310,28 @@ class Environment(object):
         else:
             raise KeyError(var[0])
 
-        # Solve dotted variables
+        # Compute lazy values once and keep the result for the render
         value = scope[var[0]]
+        if isinstance(value, LazyValue):
+            value = scope[var[0]] = value.get()
+
+        # Solve dotted variables
+        if len(var) > 1:
+            value = self._resolve(value, var)
+
+        return value
+
+    def _get_global(self, var):
+        """ Get a dotted variable from the global scope only. """
+        scope = self._scope_stack[0]._local
+        if not var[0] in scope or isinstance(scope[var[0]], LazyValue):
+            raise KeyError(var[0])
+
+        return self._resolve(scope[var[0]], var)
+
+    def _resolve(self, value, var):
+        """ Solve the dotted parts of a variable starting from a value. """
+
         for dot in var[1:]:
 
             if dot[0:1] == "#":
@@ -130,16 +358,21 @@ class Environment(object):
                     except:
                         raise KeyError(dot)
 
+            if isinstance(value, LazyValue):
+                value = value.get()
+
         return value
 
     def load_import(self, name):
         """ Load a lib from an importer. """
+        importer = self._importers[name]
+        if isinstance(importer, (str, type)):
+            return _shared_library(importer)
 
+        # Other callables, such as closures, may be created per environment
+        # and are not kept beyond it
         if not name in self._imported:
-            if not name in self._importers:
-                raise KeyError(name)
-
-            self._imported[name] = self._importers[name]()
+            self._imported[name] = importer()
 
         return self._imported[name]
 
@@ -19,6 +19,14 @@ class RestrictedError(Error):
     pass
 
 
+class PrecompileError(Error):
+    """ Collect the errors found while precompiling many templates. """
+
+    def __init__(self, errors):
+        Error.__init__(self, "\n".join(str(error) for error in errors))
+        self.errors = errors
+
+
 class TemplateError(Error):
     """ An error at a specific location in atemplate file. """
 
@@ -5,7 +5,8 @@ __copyright__   = "Copyright 2016"
 __license__     = "Apache License 2.0"
 
 __all__ = [
-    "Expr", "ValueExpr", "FuncExpr", "ListExpr", "VarExpr", "IndexExpr"
+    "Expr", "ValueExpr", "FuncExpr", "ListExpr", "VarExpr", "IndexExpr",
+    "UnaryExpr", "BinaryExpr", "CompareExpr", "AndExpr", "OrExpr"
 ]
 
 
@@ -15,44 +16,54 @@ from .errors import *
 class Expr(object):
     """ Base for an expression object. """
 
+    __slots__ = ("_template", "_line")
+
     def __init__(self, template, line):
         """ Initialize the expression object. """
         self._template = template
-        self._env = template._env
         self._line = line
 
-    def eval(self):
+    def eval(self, env):
         """ Evaluate the expression object. """
         raise NotImplementedError
 
 
 class ValueExpr(Expr):
     """ An expression that represents a value. """
+    __slots__ = ("_value",)
 
     def __init__(self, template, line, value):
         """ Initialize the value expression. """
         Expr.__init__(self, template, line)
         self._value = value
 
-    def eval(self):
+    def eval(self, env):
         """ Evaluate the expression. """
         return self._value
 
 
 class FuncExpr(Expr):
     """ A function expression node. """
+    __slots__ = ("_var", "_nodes", "_folded")
 
     def __init__(self, template, line, var, nodes):
         """ Initialize the node. """
         Expr.__init__(self, template, line)
-        self._var = var
-        self._nodes = nodes
+        self._var = tuple(var)
+        self._nodes = tuple(nodes)
+        self._folded = None # (fn, result) computed when parsed
 
-    def eval(self):
+    def eval(self, env):
         """ Evaluate the expression. """
         try:
-            fn = self._env.get(self._var)
-            params = [node.eval() for node in self._nodes]
+            fn = env.get(self._var)
+            folded = self._folded
+            if folded is not None and folded[0] is fn:
+                return folded[1]
+
+            params = [node.eval(env) for node in self._nodes]
+            if env._memo is not None and getattr(fn, "_template_memoize", False):
+                return env._call_memoized(fn, params)
             return fn(*params)
         except KeyError:
             raise UnknownVariableError(
@@ -64,29 +75,31 @@ class FuncExpr(Expr):
 
 class ListExpr(Expr):
     """ A list expression node. """
+    __slots__ = ("_nodes",)
     
     def __init__(self, template, line, nodes):
         """ Initialize the node. """
         Expr.__init__(self, template, line)
-        self._nodes = nodes
+        self._nodes = tuple(nodes)
 
-    def eval(self):
+    def eval(self, env):
         """ Evaluate the expression. """
-        return [node.eval() for node in self._nodes]
+        return [node.eval(env) for node in self._nodes]
 
 
 class VarExpr(Expr):
     """ An expression that represents a variable. """
+    __slots__ = ("_var",)
 
     def __init__(self, template, line, var):
         """ Initialize the variable expression. """
         Expr.__init__(self, template, line)
-        self._var = var
+        self._var = tuple(var)
 
-    def eval(self):
+    def eval(self, env):
         """ Evaluate the expression. """
         try:
-            return self._env.get(self._var)
+            return env.get(self._var)
         except KeyError:
             raise UnknownVariableError(
                 ".".join(self._var),
@@ -97,18 +110,19 @@ class VarExpr(Expr):
 
 class IndexExpr(Expr):
     """ An array index expression node. """
+    __slots__ = ("_var", "_nodes")
 
     def __init__(self, template, line, var, nodes):
         """ Initialize the node. """
         Expr.__init__(self, template, line)
-        self._var = var
-        self._nodes = nodes
+        self._var = tuple(var)
+        self._nodes = tuple(nodes)
 
-    def eval(self):
+    def eval(self, env):
         """ Evaluate the expression. """
         try:
-            var = self._env.get(self._var)
-            params = [node.eval() for node in self._nodes]
+            var = env.get(self._var)
+            params = [node.eval(env) for node in self._nodes]
         except KeyError:
             raise UnknownVariableError(
                 ".".join(self._var),
@@ -131,3 +145,86 @@ class IndexExpr(Expr):
 
         return var
 
+
+
+class UnaryExpr(Expr):
+    """ An expression applying an operator to a single value. """
+    __slots__ = ("_fn", "_expr")
+
+    def __init__(self, template, line, fn, expr):
+        """ Initialize the expression. """
+        Expr.__init__(self, template, line)
+        self._fn = fn
+        self._expr = expr
+
+    def eval(self, env):
+        """ Evaluate the expression. """
+        return self._fn(self._expr.eval(env))
+
+
+class BinaryExpr(Expr):
+    """ An expression applying an operator to two values. """
+    __slots__ = ("_fn", "_left", "_right")
+
+    def __init__(self, template, line, fn, left, right):
+        """ Initialize the expression. """
+        Expr.__init__(self, template, line)
+        self._fn = fn
+        self._left = left
+        self._right = right
+
+    def eval(self, env):
+        """ Evaluate the expression. """
+        return self._fn(self._left.eval(env), self._right.eval(env))
+
+
+class CompareExpr(Expr):
+    """ A chain of comparisons such as a < b <= c. """
+    __slots__ = ("_first", "_ops")
+
+    def __init__(self, template, line, first, ops):
+        """ Initialize with the first value and a list of (fn, expr). """
+        Expr.__init__(self, template, line)
+        self._first = first
+        self._ops = tuple(ops)
+
+    def eval(self, env):
+        """ Evaluate the expression, stopping at the first false result. """
+        left = self._first.eval(env)
+        for (fn, expr) in self._ops:
+            right = expr.eval(env)
+            if not fn(left, right):
+                return False
+            left = right
+
+        return True
+
+
+class AndExpr(Expr):
+    """ A short-circuit and expression. """
+    __slots__ = ("_left", "_right")
+
+    def __init__(self, template, line, left, right):
+        """ Initialize the expression. """
+        Expr.__init__(self, template, line)
+        self._left = left
+        self._right = right
+
+    def eval(self, env):
+        """ Evaluate the expression. """
+        return self._left.eval(env) and self._right.eval(env)
+
+
+class OrExpr(Expr):
+    """ A short-circuit or expression. """
+    __slots__ = ("_left", "_right")
+
+    def __init__(self, template, line, left, right):
+        """ Initialize the expression. """
+        Expr.__init__(self, template, line)
+        self._left = left
+        self._right = right
+
+    def eval(self, env):
+        """ Evaluate the expression. """
+        return self._left.eval(env) or self._right.eval(env)
@@ -0,0 +1,205 @@
+""" Render a template again, reusing the output of unaffected parts. """
+
+__author__      = "Brian Allen Vanderburg II"
+__copyright__   = "Copyright 2016"
+__license__     = "Apache License 2.0"
+
+__all__ = ["IncrementalRender"]
+
+
+import copy
+
+from .env import Environment
+from .scope import Scope
+from .nodes import SectionNode, UseSectionNode, render_iterative
+from .metrics import perf_counter
+
+
+_MISSING = object()
+
+
+class _Block(object):
+    """ What a top-level node did during its last render. """
+    __slots__ = ("reads", "writes", "written", "sections", "output")
+
+    def __init__(self):
+        """ Initialize the block. """
+        self.reads = set()
+        self.writes = [] # (method, args) calls to replay
+        self.written = set() # None if the scope was cleared
+        self.sections = False
+        self.output = None
+
+
+class _Recorder(object):
+    """ Record the reads and writes of a block as the environment makes them. """
+    __slots__ = ("_block", "_scope")
+
+    def __init__(self, block, scope):
+        """ Initialize the recorder for a block rendered in a template scope. """
+        self._block = block
+        self._scope = scope
+
+    def _persists(self, env, where=Scope.SCOPE_LOCAL):
+        """ Writes to the template's own scope or the global scope outlast the
+            block, writes to nested scopes do not.
+        """
+        if where == Scope.SCOPE_GLOBAL:
+            return True
+        if where == Scope.SCOPE_TEMPLATE:
+            return env._scope._template is self._scope._template
+        return env._scope is self._scope
+
+    def get(self, env, var):
+        """ Record a read. """
+        self._block.reads.add(var[0])
+
+    def set(self, env, name, value, where):
+        """ Record a set. """
+        if self._persists(env, where):
+            self._block.writes.append((Environment.set, (name, value, where)))
+            self._block.written.add(name)
+
+    def update(self, env, values):
+        """ Record an update. """
+        if self._persists(env):
+            self._block.writes.append((Environment.update, (dict(values),)))
+            self._block.written.update(values)
+
+    def unset(self, env, name):
+        """ Record an unset. """
+        if self._persists(env):
+            self._block.writes.append((Environment.unset, (name,)))
+            self._block.written.add(name)
+
+    def clear(self, env):
+        """ Record a clear. """
+        if self._persists(env):
+            self._block.writes.append((Environment.clear, ()))
+            self._block.written = None
+
+
+class IncrementalRender(object):
+    """ Render a template repeatedly with changing values.
+
+        Each top-level node of the template is a block.  The variables read
+        and written by each block are recorded when it is rendered.  On later
+        renders, a block that read none of the changed values is not rendered
+        again.  Its earlier output is reused and its writes are repeated, so
+        the blocks after it see the same values.  Blocks that use sections are
+        always rendered.
+    """
+
+    def __init__(self, template):
+        """ Initialize for a template. """
+        self._template = template
+        self._blocks = None
+        self._context = None
+
+    def render(self, renderer, context=None, changed=None, finish=True):
+        """ Render the template.  The names of the changed values can be given
+            in changed.  Otherwise values are compared to the previous render,
+            so values changed in place must be given in changed.  The renderer
+            is finished as by Template.render.
+        """
+        template = self._template
+        context = dict(context or {})
+
+        blocks = self._blocks
+        if blocks is None:
+            blocks = [None] * len(template._nodes)
+            dirty = None
+        elif changed is not None:
+            dirty = set(changed)
+        else:
+            dirty = self._changed(self._context, context)
+
+        self._blocks = None
+
+        # Render in a copy of the environment with its own scope stack, so
+        # the recorder does not see other renders of the environment
+        env = copy.copy(template._env)
+        env._scope_stack = list(env._scope_stack)
+        toplevel = len(env._scope_stack) == 1
+        metrics = env._metrics
+        metrics._enter(env)
+        start = perf_counter()
+
+        scope = env._push_scope(True)
+        try:
+            scope._local.update(context)
+            scope._template["__filename__"] = template._filename
+
+            for (index, node) in enumerate(template._nodes):
+                previous = block = blocks[index]
+                if block is None or block.sections or dirty is None or not block.reads.isdisjoint(dirty):
+                    block = blocks[index] = self._run(env, renderer, scope, node)
+                    if dirty is not None:
+                        # Names written last time but not this time changed too
+                        if block.written is None or previous.written is None:
+                            dirty = None
+                        else:
+                            dirty.update(block.written)
+                            dirty.update(previous.written)
+                else:
+                    renderer.render(block.output)
+                    for (method, args) in block.writes:
+                        method(env, *args)
+        finally:
+            env._pop_scope()
+            if toplevel and env._memo:
+                env._memo.clear()
+            metrics._leave(env, template._filename, perf_counter() - start)
+
+        self._blocks = blocks
+        self._context = context
+        if finish and hasattr(renderer, "finish"):
+            renderer.finish()
+
+    @staticmethod
+    def _changed(old, new):
+        """ Return the names of values that differ between two contexts. """
+        result = set()
+        for name in set(old) | set(new):
+            value = new.get(name, _MISSING)
+            previous = old.get(name, _MISSING)
+            if value is not previous and value != previous:
+                result.add(name)
+
+        return result
+
+    def _run(self, env, renderer, scope, node):
+        """ Render a block and record what it does. """
+        block = _Block()
+
+        # Blocks with section tags are always rendered, so they are rendered
+        # directly.  Others are captured to be reused.
+        capture = True
+        for child in node.walk():
+            if isinstance(child, (SectionNode, UseSectionNode)):
+                block.sections = True
+                capture = False
+                break
+
+        section_uses = renderer._section_uses
+        env._recorder = _Recorder(block, scope)
+        try:
+            if capture:
+                renderer.push_capture()
+
+            if env._iterative:
+                render_iterative(env, (node,), renderer)
+            else:
+                node.render(env, renderer)
+
+            if capture:
+                block.output = renderer.pop_capture()
+                renderer.render(block.output)
+        finally:
+            env._recorder = None
+
+        # Sections used by included templates are only seen while rendering
+        if renderer._section_uses != section_uses:
+            block.sections = True
+
+        return block
@@ -4,6 +4,9 @@ __author__      =   "Brian Allen Vanderburg II"
 __copyright__   =   "Copyright (C) 2017 Brian Allen Vanderburg II"
 __license__     =   "Apache License 2.0"
 
+import sys
+import importlib
+
 __all__ = []
 
 
@@ -16,5 +19,57 @@ class Library(object):
     pass
 
 
-from .stdlib import StdLib
-__all__.append("StdLib")
+__all__.append("pure")
+def pure(fn):
+    """ Mark a library function as pure.  A pure function always returns the
+        same result for the same arguments and has no side effects.  A call
+        to a pure function with only literal arguments is evaluated once when
+        the template is parsed instead of on every render, so the result must
+        not be modified afterward.
+    """
+    fn._template_pure = True
+    return fn
+
+
+__all__.append("memoize")
+def memoize(fn):
+    """ Mark a library function as safe to memoize.  When memoization is
+        enabled on the environment, the result of a call is reused for later
+        calls with the same arguments during the same top-level render.
+    """
+    fn._template_memoize = True
+    return fn
+
+
+# Libraries are imported from their module on first use
+_lazy = {
+    "StdLib": ".stdlib",
+    "CollectionLib": ".collection",
+    "ElementTreeWrapper": ".xml"
+}
+__all__.extend(_lazy)
+
+
+def __getattr__(name):
+    """ Import a library when it is first used. """
+    module = _lazy.get(name)
+    if module is None:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    """ Include the names not imported yet. """
+    return sorted(set(globals()) | set(_lazy))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ is not supported.  The optional xml library is left
+    # to be imported from its own module, as before.
+    __all__.remove("ElementTreeWrapper")
+    for _name in _lazy:
+        if _name in __all__:
+            __getattr__(_name)
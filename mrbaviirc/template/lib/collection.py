@@ -0,0 +1,146 @@
+""" Aggregation, sorting and grouping of collections for templates. """
+
+__author__      = "Brian Allen Vanderburg II"
+__copyright__   = "Copyright 2016"
+__license__     = "Apache License 2.0"
+
+__all__ = ["CollectionLib"]
+
+import heapq
+import itertools
+import operator
+
+from . import pure
+
+
+_getters = {}
+_EMPTY = object()
+
+
+def _get_part(part):
+    """ Return a function to get one part of a key from a value. """
+
+    if part[0:1] == "#":
+        return operator.itemgetter(part[1:])
+
+    if part[0:1] == "@":
+        return operator.attrgetter(part[1:])
+
+    def getter(value):
+        try:
+            return value[part]
+        except (KeyError, IndexError, TypeError):
+            return getattr(value, part)
+    return getter
+
+
+def _getter(key):
+    """ Return a function to get a dotted key from a value.  Like template
+        variables, each part is looked up as an item then as an attribute,
+        unless prefixed with "#" for items only or "@" for attributes only.
+        The functions are kept for later use.
+    """
+
+    if key is None:
+        return None
+
+    getter = _getters.get(key)
+    if getter is None:
+        parts = [_get_part(part) for part in key.split(".")]
+        if len(parts) == 1:
+            getter = parts[0]
+        else:
+            def getter(value):
+                for part in parts:
+                    value = part(value)
+                return value
+
+        _getters[key] = getter
+
+    return getter
+
+
+def _choose(choose, values, key, default):
+    """ Return min or max of the values by a key, or default if there are no
+        values.  Python 2 has no default argument and early Python 3 versions
+        do not accept a key of None.
+    """
+    values = iter(values)
+    first = next(values, _EMPTY)
+    if first is _EMPTY:
+        return default
+
+    values = itertools.chain((first,), values)
+    getter = _getter(key)
+    if getter is None:
+        return choose(values)
+    return choose(values, key=getter)
+
+
+class CollectionLib(object):
+    """ Work with whole collections at once. """
+
+    @pure
+    def sum(self, values, key=None, start=0):
+        """ Return the sum of the values or of a key of each value. """
+        getter = _getter(key)
+        if getter:
+            values = map(getter, values)
+        return sum(values, start)
+
+    @pure
+    def min(self, values, key=None, default=None):
+        """ Return the value with the smallest key. """
+        return _choose(min, values, key, default)
+
+    @pure
+    def max(self, values, key=None, default=None):
+        """ Return the value with the largest key. """
+        return _choose(max, values, key, default)
+
+    def sorted(self, values, key=None, reverse=False):
+        """ Return a list of the values sorted by a key. """
+        return sorted(values, key=_getter(key), reverse=reverse)
+
+    def groupby(self, values, key):
+        """ Return a list of groups in order of first appearance, each a dict
+            with the "key" and a list of the "values" with that key.  The
+            values do not need to be sorted.
+        """
+        getter = _getter(key)
+        groups = {}
+        result = []
+        for value in values:
+            group_key = getter(value)
+            items = groups.get(group_key)
+            if items is None:
+                items = groups[group_key] = []
+                result.append({"key": group_key, "values": items})
+            items.append(value)
+
+        return result
+
+    def unique(self, values, key=None):
+        """ Return a list of the values without repeated keys. """
+        getter = _getter(key)
+        seen = set()
+        result = []
+        for value in values:
+            unique_key = getter(value) if getter else value
+            if not unique_key in seen:
+                seen.add(unique_key)
+                result.append(value)
+
+        return result
+
+    def zip(self, *values):
+        """ Return an iterator over lists of the items at each position. """
+        return map(list, zip(*values))
+
+    def topk(self, values, count, key=None):
+        """ Return a list of the count values with the largest keys. """
+        return heapq.nlargest(count, values, key=_getter(key))
+
+    def bottomk(self, values, count, key=None):
+        """ Return a list of the count values with the smallest keys. """
+        return heapq.nsmallest(count, values, key=_getter(key))
@@ -6,6 +6,16 @@ __license__     = "Apache License 2.0"
 
 __all__ = []
 import os
+import itertools
+import collections
+
+from . import pure
+from ..markup import SafeString, escape
+
+try:
+    _range = xrange # Python 2 range builds a list
+except NameError:
+    _range = range
 
 
 
@@ -17,22 +27,27 @@ class _PathLib(object):
         """ The path separator for the current platform. """
         return os.sep
 
+    @pure
     def join(self, *parts):
         """ Join a path. """
         return os.path.join(*parts)
 
+    @pure
     def split(self, path):
         """ Split a path into a head and a tail. """
         return os.path.split(path)
 
+    @pure
     def splitext(self, path):
         """ Split the extension out of the path. """
         return os.path.splitext(path)
 
+    @pure
     def dirname(self, path):
         """ Return the directory name of a path. """
         return os.path.dirname(path)
 
+    @pure
     def basename(self, path):
         """ Return the base name of a path. """
         return os.path.basename(path)
@@ -45,6 +60,7 @@ class _PathLib(object):
 class _StringLib(object):
     """ String based functions. """
 
+    @pure
     def concat(self, *values):
         """ Concatenate values. """
         return "".join(values)
@@ -53,26 +69,32 @@ class _StringLib(object):
         """ Split a value into parts. """
         return value.split(delim)
 
+    @pure
     def join(self, delim, values):
         """ Join a value from parts. """
         return delim.join(values)
 
+    @pure
     def replace(self, source, target, value):
         """ Replace all source with target in value. """
         return value.replace(source, target)
 
+    @pure
     def strip(self, value, what=None):
         """ Strip from the start and end of value. """
         return value.strip(what)
 
+    @pure
     def rstrip(self, value, what=None):
         """ Strip from the end of value. """
         return value.rstrip(what)
 
+    @pure
     def lstrip(self, value, what=None):
         """ Strip from the start of value. """
         return value.lstrip(what)
 
+    @pure
     def substr(self, value, start, end=None):
         """ Get a substring from start up to but not including end. """
         if end is None:
@@ -80,10 +102,12 @@ class _StringLib(object):
         else:
             return value[start:end]
 
+    @pure
     def find(self, value, what, pos=None):
         """ Find a value, -1 if not found. """
         return value.find(what, pos)
 
+    @pure
     def rfind(self, value, what, pos=None):
         """ Find a vlue, -1 if not found. """
         return value.rfind(what, 0, pos)
@@ -128,13 +152,50 @@ class _ListLib(object):
         """ Return a sublist from start up to but not including end. """
         return l[start:end]
 
+    # The following return iterators and so are not pure, since a folded
+    # iterator could only be used once.
+
+    def reversed(self, l):
+        """ Return an iterator over the items of a sequence in reverse. """
+        return reversed(l)
+
+    def islice(self, l, start, end=None, step=None):
+        """ Return an iterator over the items from start up to end. """
+        return itertools.islice(l, start, end, step)
+
+    def chunks(self, l, size):
+        """ Return an iterator over lists of up to size items. """
+        iterator = iter(l)
+        while True:
+            chunk = list(itertools.islice(iterator, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def window(self, l, size):
+        """ Return an iterator over each run of size consecutive items. """
+        iterator = iter(l)
+        window = collections.deque(itertools.islice(iterator, size), size)
+        if len(window) < size:
+            return
+        yield list(window)
+        for item in iterator:
+            window.append(item)
+            yield list(window)
+
 
 class _HtmlLib(object):
     """ An HTML library for escaping values. """
 
+    @pure
     def esc(self, value, quote=False):
         """ Escape for HTML. """
-        return cgi.escape(value, quote)
+        return escape(value, quote)
+
+    @pure
+    def safe(self, value):
+        """ Mark a value as already escaped. """
+        return SafeString(value)
 
 
 class _IndentLib(object):
@@ -210,75 +271,93 @@ class StdLib(object):
         """ Return a new indenter. """
         return _IndentLib(indent)
 
+    @pure
     def str(self, value):
         """ Return the string of an value. """
         return str(value)
 
+    @pure
     def int(self, value):
         """ Return the interger of a value. """
         return int(value)
 
+    @pure
     def float(self, value):
         """ Return the float of a value. """
         return float(value)
 
+    @pure
     def count(self, value):
         """ Return how many things are in a value. """
         return len(value)
 
+    @pure
     def add(self, value1, value2):
         """ Add two values. """
         return value1 + value2
 
+    @pure
     def sub(self, value1, value2):
         """ Subtract two values. """
         return value1 - value2
 
+    @pure
     def mul(self, value1, value2):
         """ Multiply two values """
         return value1 * value2
 
+    @pure
     def div(self, value1, value2):
         """ Divide two values """
         return value1 / value2
 
+    @pure
     def mod(self, value1, value2):
         """ Take the remainder of division. """
         return value1 % value2
 
+    @pure
     def iseven(self, value):
         """ Determine if a value is even. """
         return (value % 2) == 0
 
+    @pure
     def isodd(self, value):
         """ Determine if a value is odd. """
         return (value % 2) == 1
 
+    @pure
     def eq(self, value1, value2):
         """ Determine if two values are equal. """
         return value1 == value2
 
+    @pure
     def ne(self, value1, value2):
         """ Determine if two values are not equal. """
         return value1 != value2
 
+    @pure
     def lt(self, value1, value2):
         """ Determine if value1 is < value2 """
         return value1 < value2
 
+    @pure
     def gt(self, value1, value2):
         """ Determine if value1 is > value2 """
         return value1 > value2
 
+    @pure
     def le(self, value1, value2):
         """ Determine if value1 is <= value2 """
         return value1 <= value2
 
+    @pure
     def ge(self, value1, value2):
         """ Determine if value1 is >= value2 """
         return value1 >= value2
 
-    def seq(self, start, end, step=None):
-        """ Return a generater sequence from start up to end. """
-        return range(start, end, 1)
+    @pure
+    def seq(self, start, end, step=1):
+        """ Return a lazy sequence from start up to end. """
+        return _range(start, end, step)
 
@@ -9,8 +9,8 @@ __all__ = ["Loader", "UnrestrictedLoader", "SearchPathLoader", "MemoryLoader"]
 import os
 import posixpath
 
-from .template import Template
 from .errors import *
+from .metrics import Metrics, perf_counter
 
 try:
     from codecs import open
@@ -23,11 +23,28 @@ class Loader(object):
 
     def __init__(self):
         """ Initialize the loader. """
-        pass
+        self._metrics = Metrics()
 
     def load_template(filename, parent=None):
         raise NotImplementedError
 
+    def metrics(self):
+        """ Return the metrics of loading templates. """
+        return self._metrics
+
+    def _create_template(self, env, text, filename):
+        """ Parse the text of a template. """
+        # Imported here so loaders can be imported without the parser
+        from .template import Template
+
+        metrics = self._metrics
+        start = perf_counter()
+        template = Template(env, text, filename)
+        metrics.parses += 1
+        metrics.parse_time += perf_counter() - start
+
+        return template
+
 
 class UnrestrictedLoader(Loader):
     """ A loader that loads any template specified. """
@@ -52,13 +69,16 @@ class UnrestrictedLoader(Loader):
 
         # Available from cache?
         if filename in self._cache:
+            self._metrics.cache_hits += 1
             return self._cache[filename]
 
+        self._metrics.cache_misses += 1
+
         # Load and return
         with open(filename, "rU") as handle:
             text = handle.read()
 
-        self._cache[filename] = Template(env, text, filename)
+        self._cache[filename] = self._create_template(env, text, filename)
         return self._cache[filename]
 
 
@@ -100,15 +120,18 @@ class SearchPathLoader(Loader):
 
         # Available from cache?
         if cachename in self._cache:
+            self._metrics.cache_hits += 1
             return self._cache[cachename]
 
+        self._metrics.cache_misses += 1
+
         # Find the real file and load it
         (index, realname) = self._find_template(filename, search_index)
         with open(realname, "rU") as handle:
             text = handle.read()
 
         # Create the template item
-        result = Template(env, text, filename)
+        result = self._create_template(env, text, filename)
         result._private["search_index"] = index
 
         self._cache[cachename] = result
@@ -138,6 +161,28 @@ class SearchPathLoader(Loader):
 
         return self._find_cache[cachename]
 
+    def list_templates(self, extensions=(".tmpl",)):
+        """ Return the names of all templates found along the search path.
+
+            Names are returned in the form accepted by load_template.  A name
+            found in more than one path is only returned once since only the
+            first will be loaded.  If extensions is empty, all files are used.
+        """
+
+        extensions = tuple(extensions) if extensions else None
+        found = set()
+
+        for path in self._path:
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                for filename in filenames:
+                    if extensions and not filename.endswith(extensions):
+                        continue
+
+                    relname = os.path.relpath(os.path.join(dirpath, filename), path)
+                    found.add("/" + relname.replace(os.sep, "/"))
+
+        return sorted(found)
+
 
 class MemoryLoader(Loader):
     """ Load from memory. """
@@ -164,15 +209,18 @@ class MemoryLoader(Loader):
 
         # Available in cache
         if filename in self._cache:
+            self._metrics.cache_hits += 1
             return self._cache[filename]
 
+        self._metrics.cache_misses += 1
+
         if not filename in self._memory:
             raise RestrictedError(
                 "Attempt to load non-existing template from memory: {0}".format(filename)
             )
 
         # Load the file
-        self._cache[filename] = Template(env, self._memory[filename], filename)
+        self._cache[filename] = self._create_template(env, self._memory[filename], filename)
         return self._cache[filename]
 
 
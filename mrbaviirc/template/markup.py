@@ -0,0 +1,38 @@
+""" Escaping of values for HTML output. """
+
+__author__      = "Brian Allen Vanderburg II"
+__copyright__   = "Copyright 2016"
+__license__     = "Apache License 2.0"
+
+__all__ = ["SafeString", "escape"]
+
+
+class SafeString(str):
+    """ A string that is already escaped and is output as is. """
+
+    def __html__(self):
+        """ Return the escaped form of the string. """
+        return self
+
+
+def escape(value, quote=True):
+    """ Escape a value for HTML unless it is already safe.  If quote is true,
+        quotes are also escaped so the result can be used in attributes.
+    """
+    if hasattr(value, "__html__"):
+        return SafeString(value.__html__())
+
+    value = str(value)
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    if quote:
+        if '"' in value:
+            value = value.replace('"', "&quot;")
+        if "'" in value:
+            value = value.replace("'", "&#x27;")
+
+    return SafeString(value)
@@ -0,0 +1,166 @@
+""" Count and time the loading and rendering of templates. """
+
+__author__      = "Brian Allen Vanderburg II"
+__copyright__   = "Copyright 2016"
+__license__     = "Apache License 2.0"
+
+__all__ = ["Metrics"]
+
+import os
+import threading
+from bisect import bisect_left
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter # Python 2
+
+
+class Metrics(object):
+    """ Counters and timings kept by an environment or a loader. """
+
+    # Upper bounds in seconds of the render time histogram buckets
+    BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        """ Initialize the metrics. """
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.parses = 0
+        self.parse_time = 0.0
+        self.max_include_depth = 0
+        self._lock = threading.Lock()
+
+        # Template name to [count, seconds, bucket counts]
+        self._renders = {}
+
+    @property
+    def loads(self):
+        """ The number of templates requested. """
+        return self.cache_hits + self.cache_misses
+
+    def _enter(self, env):
+        """ Note the start of rendering a template.  The depth is kept by the
+            environment, since forks rendering at the same time share the
+            metrics.
+        """
+        depth = env._depth = env._depth + 1
+        if depth > self.max_include_depth:
+            with self._lock:
+                if depth > self.max_include_depth:
+                    self.max_include_depth = depth
+
+    def _leave(self, env, name, seconds):
+        """ Note the end of rendering a template. """
+        env._depth -= 1
+
+        with self._lock:
+            entry = self._renders.get(name)
+            if entry is None:
+                entry = self._renders[name] = [0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2][bisect_left(self.BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        """ Return the current values as a dictionary. """
+        return {
+            "loads": self.loads,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "parses": self.parses,
+            "parse_time": self.parse_time,
+            "max_include_depth": self.max_include_depth,
+            "renders": dict(
+                (name, {"count": entry[0], "time": entry[1]})
+                for (name, entry) in self._renders.items()
+            )
+        }
+
+    def prometheus(self, prefix="mrbaviirc_template"):
+        """ Return the values in the Prometheus text format.  Only the loading
+            or the rendering values are included if the other is unused, so
+            the output of an environment and a loader can be combined.
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP {0}_{1} {2}".format(prefix, name, help))
+            lines.append("# TYPE {0}_{1} {2}".format(prefix, name, kind))
+            for (suffix, labels, value) in samples:
+                lines.append("{0}_{1}{2}{3} {4}".format(
+                    prefix, name, suffix, _labels(labels), _number(value)
+                ))
+
+        loading = self.loads or self.parses
+        rendering = self._renders or not loading
+
+        if loading:
+            metric("loads_total", "counter", "Templates requested from the loader.",
+                [("", (), self.loads)])
+            metric("cache_hits_total", "counter", "Templates found in the loader cache.",
+                [("", (), self.cache_hits)])
+            metric("cache_misses_total", "counter", "Templates not found in the loader cache.",
+                [("", (), self.cache_misses)])
+            metric("parses_total", "counter", "Templates parsed.",
+                [("", (), self.parses)])
+            metric("parse_seconds_total", "counter", "Time spent parsing templates.",
+                [("", (), self.parse_time)])
+
+        if not rendering:
+            return "\n".join(lines) + "\n"
+
+        metric("include_depth_max", "gauge", "Deepest nesting of templates being rendered.",
+            [("", (), self.max_include_depth)])
+
+        samples = []
+        for name in sorted(self._renders):
+            (count, seconds, buckets) = self._renders[name]
+            total = 0
+            for (bound, bucket) in zip(self.BUCKETS + (float("inf"),), buckets):
+                total += bucket
+                samples.append(("_bucket", (("template", name), ("le", bound)), total))
+            samples.append(("_sum", (("template", name),), seconds))
+            samples.append(("_count", (("template", name),), count))
+
+        metric("render_seconds", "histogram",
+            "Time spent rendering each template, including the templates it includes.",
+            samples)
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename, prefix="mrbaviirc_template"):
+        """ Write the values in the Prometheus text format to a file, such as
+            for the node exporter textfile collector.  The file is replaced
+            in a single step so it is never read partially written.
+        """
+        temp = "{0}.{1}.tmp".format(filename, os.getpid())
+        with open(temp, "w") as handle:
+            handle.write(self.prometheus(prefix))
+        if hasattr(os, "replace"):
+            os.replace(temp, filename)
+        else:
+            os.rename(temp, filename) # Python 2, replaces only on POSIX
+
+
+def _number(value):
+    """ Format a number for the Prometheus text format. """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+
+def _labels(labels):
+    """ Format labels for the Prometheus text format. """
+    if not labels:
+        return ""
+
+    return "{" + ",".join(
+        '{0}="{1}"'.format(
+            name,
+            _number(value) if isinstance(value, float) else
+                str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for (name, value) in labels
+    ) + "}"
@@ -5,71 +5,138 @@ __copyright__   = "Copyright 2016"
 __license__     = "Apache License 2.0"
 
 __all__ = [
-    "Node", "NodeList",  "TextNode", "IfNode", "ForNode", "SwitchNode",
-    "EmitNode", "IncludeNode", "ReturnNode", "AssignNode", "SectionNode",
-    "UseSectionNode", "ScopeNode", "VarNode", "ErrorNode","ImportNode",
-    "DoNode", "UnsetNode", "CodeNode", "ExpandNode"
+    "Node", "NodeList", "freeze_nodes", "TextNode", "IfNode", "ForNode",
+    "SwitchNode", "EmitNode", "IncludeNode", "ReturnNode", "AssignNode",
+    "SectionNode", "UseSectionNode", "ScopeNode", "VarNode", "ErrorNode","ImportNode",
+    "DoNode", "UnsetNode", "CodeNode", "ExpandNode", "EscapeEmitNode",
+    "LoopInfo", "render_iterative"
 ]
 
 
+from bisect import bisect_left
+
 from .errors import *
-from .renderers import StringRenderer
+from .expr import ValueExpr
+from .markup import SafeString, escape
 from .scope import *
 
 
+def freeze_nodes(nodes):
+    """ Freeze a node list built while parsing into a tuple. """
+    if isinstance(nodes, tuple):
+        return nodes
+
+    for node in nodes:
+        node._freeze()
+    return tuple(nodes)
+
+
+def render_iterative(env, nodes, renderer):
+    """ Render nodes without using recursion for nested nodes.
+
+        Nodes containing other nodes provide an _iter generator that yields a
+        (nodes, renderer) pair for each body to render, and continues once the
+        body is done.  Instead of calling each other, the generators are kept
+        on an explicit stack, so the depth of includes and other nesting is
+        not limited by the Python recursion limit.
+    """
+    stack = [(None, iter(nodes), renderer)]
+
+    try:
+        while stack:
+            (gen, items, target) = stack[-1]
+
+            for node in items:
+                if node._iter is None:
+                    node.render(env, target)
+                    continue
+
+                child = node._iter(env, target)
+                body = next(child, None)
+                if body is not None:
+                    stack.append((child, iter(body[0]), body[1]))
+                    break
+            else:
+                # Body complete, continue with the node that provided it
+                stack.pop()
+                if gen is not None:
+                    body = next(gen, None)
+                    if body is not None:
+                        stack.append((gen, iter(body[0]), body[1]))
+    except:
+        # Let any pending generators clean up their scopes
+        while stack:
+            (gen, items, target) = stack.pop()
+            if gen is not None:
+                gen.close()
+        raise
+
+
 class Node(object):
     """ A node is a part of the expression that is rendered. """
+    __slots__ = ("_template", "_line")
+
+    # Generator yielding nested bodies for render_iterative, if any
+    _iter = None
 
     def __init__(self, template, line):
         """ Initialize the node. """
         self._template = template
         self._line = line
-        self._env = template._env
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Render the node to a renderer. """
         raise NotImplementedError
 
+    def _freeze(self):
+        """ Freeze any node lists once parsing is complete. """
+        pass
 
-class NodeList(object):
-    """ A list of nodes. """
+    def _children(self):
+        """ Return the node lists contained in this node. """
+        return ()
 
-    def __init__(self):
-        """Initialize. """
-        self._nodes = []
+    def walk(self):
+        """ Yield this node and every node nested below it. """
+        yield self
+        for nodes in self._children():
+            for node in nodes:
+                for child in node.walk():
+                    yield child
 
-    def append(self, node):
-        """ Append a node to the list. """
-        self._nodes.append(node)
 
-    def extend(self, nodelist):
-        """ Extend one node list with another. """
-        self._nodes.extend(nodelist._nodes)
-
-    def render(self, renderer):
-        """ Render all nodes. """
-        for node in self._nodes:
-            node.render(renderer)
-
-    def __getitem__(self, n):
-        return self._nodes[n]
+class NodeList(list):
+    """ A list of nodes used while parsing.  Once parsing is complete, the
+        node lists are frozen into tuples.
+    """
+    __slots__ = ()
 
 
 class TextNode(Node):
     """ A node that represents a raw block of text. """
+    __slots__ = ("_text", "_encoded")
 
     def __init__(self, template, line, text):
         """ Initialize a text node. """
         Node.__init__(self, template, line)
         self._text = text
+        self._encoded = None
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Render content from a text node. """
-        renderer.render(self._text)
+        renderer.render_static(self)
+
+    def encoded(self, encoding):
+        """ Return the text encoded, reusing the result on later calls. """
+        cached = self._encoded
+        if cached is None or cached[0] != encoding:
+            cached = self._encoded = (encoding, self._text.encode(encoding))
+        return cached[1]
 
 
 class IfNode(Node):
     """ A node that manages if/elif/else. """
+    __slots__ = ("_ifs", "_else", "_nodes")
 
     def __init__(self, template, line, expr):
         """ Initialize the if node. """
@@ -89,27 +156,116 @@ class IfNode(Node):
         self._else = NodeList()
         self._nodes = self._else
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Render the if node. """
         for (expr, nodes) in self._ifs:
-            result = expr.eval()
+            result = expr.eval(env)
             if result:
-                nodes.render(renderer)
+                for node in nodes:
+                    node.render(env, renderer)
+                return
+
+        if self._else:
+            for node in self._else:
+                node.render(env, renderer)
+
+    def _iter(self, env, renderer):
+        """ Yield the branch to render. """
+        for (expr, nodes) in self._ifs:
+            if expr.eval(env):
+                yield (nodes, renderer)
                 return
 
         if self._else:
-            self._else.render(renderer)
+            yield (self._else, renderer)
+
+    def _freeze(self):
+        """ Freeze the node lists of each branch. """
+        self._ifs = tuple((expr, freeze_nodes(nodes)) for (expr, nodes) in self._ifs)
+        if self._else is not None:
+            self._else = freeze_nodes(self._else)
+        self._nodes = None
+
+    def _children(self):
+        """ Return the node lists of each branch. """
+        result = [nodes for (expr, nodes) in self._ifs]
+        if self._else is not None:
+            result.append(self._else)
+        return result
+
+
+_END = object()
+
+
+class LoopInfo(object):
+    """ Information about the current iteration of a for loop.  Values are
+        read one ahead so last is known without materializing the values.
+    """
+    __slots__ = ("_values", "_iter", "_next", "_length", "index")
+
+    def __init__(self, values, iterator=None):
+        """ Initialize the loop information.  An iterator already created
+            from the values can be given so they are not iterated twice.
+        """
+        self._values = values
+        self._iter = iter(values) if iterator is None else iterator
+        self._next = next(self._iter, _END)
+        self._length = None
+        self.index = -1
+
+    def __iter__(self):
+        """ Iterate over the values of the loop. """
+        return self
+
+    def __next__(self):
+        """ Advance to the next value. """
+        value = self._next
+        if value is _END:
+            raise StopIteration
+
+        self._next = next(self._iter, _END)
+        self.index += 1
+        return value
+
+    next = __next__
+
+    @property
+    def first(self):
+        """ Whether this is the first iteration. """
+        return self.index == 0
+
+    @property
+    def last(self):
+        """ Whether this is the last iteration. """
+        return self._next is _END
+
+    @property
+    def length(self):
+        """ The number of values.  If the values have no length, the rest of
+            them are read into a list to count them.
+        """
+        if self._length is None:
+            try:
+                self._length = len(self._values)
+            except TypeError:
+                rest = list(self._iter)
+                self._iter = iter(rest)
+                remaining = len(rest) + (0 if self._next is _END else 1)
+                self._length = self.index + 1 + remaining
+        return self._length
 
 
 class ForNode(Node):
     """ A node for handling for loops. """
+    __slots__ = ("_var", "_cvar", "_expr", "_loop", "_for", "_else", "_nodes")
 
-    def __init__(self, template, line, var, cvar, expr):
+    def __init__(self, template, line, var, cvar, expr, loop=None):
         """ Initialize the for node. """
         Node.__init__(self, template, line)
         self._var = var
         self._cvar = cvar
         self._expr = expr
+        self._loop = loop
 
         self._for = NodeList()
         self._else = None
@@ -120,14 +276,13 @@ class ForNode(Node):
         self._else = NodeList()
         self._nodes = self._else
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Render the for node. """
-        env = self._env
 
         # Iterate over each value
-        values = self._expr.eval()
+        values = self._values(env)
         do_else = True
-        if values:
+        if values is not None:
             index = 0
             for var in values:
                 do_else = False
@@ -137,14 +292,75 @@ class ForNode(Node):
                 index += 1
                                     
                 # Execute each sub-node
-                self._for.render(renderer)
+                for node in self._for:
+                    node.render(env, renderer)
+
+        if do_else and self._else:
+            for node in self._else:
+                node.render(env, renderer)
+
+    def _iter(self, env, renderer):
+        """ Yield the loop body once for each value. """
+        values = self._values(env)
+        do_else = True
+        if values is not None:
+            index = 0
+            for var in values:
+                do_else = False
+                if self._cvar:
+                    env.set(self._cvar, index)
+                env.set(self._var, var)
+                index += 1
+
+                yield (self._for, renderer)
 
         if do_else and self._else:
-            self._else.render(renderer)
+            yield (self._else, renderer)
+
+    def _values(self, env):
+        """ Return an iterator over the values, or None for no values.  The
+            values are iterated once, never tested or measured up front.
+            Values that can not be iterated, such as False or 0, have no
+            values if they are false.
+        """
+        values = self._expr.eval(env)
+        try:
+            iterator = iter(values)
+        except TypeError:
+            if values:
+                raise
+            return None
+
+        if self._loop:
+            # The values are kept only for their length
+            iterator = LoopInfo(values, iterator)
+            env.set(self._loop, iterator)
+        return iterator
+
+    def _freeze(self):
+        """ Freeze the loop and else node lists. """
+        self._for = freeze_nodes(self._for)
+        if self._else is not None:
+            self._else = freeze_nodes(self._else)
+        self._nodes = None
+
+    def _children(self):
+        """ Return the loop and else node lists. """
+        if self._else is not None:
+            return (self._for, self._else)
+        return (self._for,)
 
 
 class SwitchNode(Node):
-    """ A node for basic if/elif/elif/else nesting. """
+    """ A node for basic if/elif/elif/else nesting.
+
+        Once parsing is complete, runs of consecutive cases comparing against
+        literal values are turned into lookup tables.  Runs of "eq" cases use
+        a dictionary and runs of "lt", "le", "gt", "ge" and "bt" cases use a
+        bisect over the sorted literal boundaries.  Other cases, and values
+        the tables can't handle, are checked one at a time in order.
+    """
+    __slots__ = ("_expr", "_default", "_cases", "_groups", "_nodes")
     types = ["lt", "le", "gt", "ge", "ne", "eq", "bt"]
     argc = [1, 1, 1, 1, 1, 1, 2]
     cbs = [
@@ -157,12 +373,17 @@ class SwitchNode(Node):
         lambda *args: args[0] >= args[1] and args[0] <= args[2]
     ]
 
+    GROUP_LINEAR = 0
+    GROUP_EQ = 1
+    GROUP_RANGE = 2
+
     def __init__(self, template, line, expr):
         """ Initialize the switch node. """
         Node.__init__(self, template, line)
         self._expr = expr
         self._default = NodeList()
         self._cases = []
+        self._groups = None
         self._nodes = self._default
 
     def add_case(self, cb, exprs):
@@ -170,47 +391,218 @@ class SwitchNode(Node):
         self._cases.append((cb, NodeList(), exprs))
         self._nodes = self._cases[-1][1]
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Render the node. """
-        value = self._expr.eval()
-
-        for cb, nodes, exprs in self._cases:
-            params = [expr.eval() for expr in exprs]
-            if cb(value, *params):
-                nodes.render(renderer)
-                return
-
-        self._default.render(renderer)
+        nodes = self._find(env, self._expr.eval(env))
+        if nodes is None:
+            nodes = self._default
+
+        for node in nodes:
+            node.render(env, renderer)
+
+    def _iter(self, env, renderer):
+        """ Yield the matching case. """
+        nodes = self._find(env, self._expr.eval(env))
+        if nodes is None:
+            nodes = self._default
+
+        yield (nodes, renderer)
+
+    def _find(self, env, value):
+        """ Return the nodes of the first matching case or None. """
+
+        for (kind, table, cases) in self._groups:
+            if kind == self.GROUP_EQ:
+                try:
+                    nodes = table.get(value)
+                except TypeError:
+                    pass # Unhashable, check the cases directly
+                else:
+                    if nodes is not None:
+                        return nodes
+                    continue
+
+            elif kind == self.GROUP_RANGE:
+                (types, points, at_point, between) = table
+                if isinstance(value, types) and value == value:
+                    index = bisect_left(points, value)
+                    if index < len(points) and points[index] == value:
+                        nodes = at_point[index]
+                    else:
+                        nodes = between[index]
+
+                    if nodes is not None:
+                        return nodes
+                    continue
+
+            for (cb, nodes, exprs) in cases:
+                params = [expr.eval(env) for expr in exprs]
+                if cb(value, *params):
+                    return nodes
+
+        return None
+
+    def _freeze(self):
+        """ Freeze the node lists of each case and build lookup tables. """
+        self._default = freeze_nodes(self._default)
+        self._cases = tuple(
+            (cb, freeze_nodes(nodes), tuple(exprs)) for (cb, nodes, exprs) in self._cases
+        )
+        self._nodes = None
+
+        # Group consecutive cases that can share a lookup table
+        runs = []
+        for case in self._cases:
+            kind = self._classify(case)
+            if runs and runs[-1][0] == kind:
+                runs[-1][1].append(case)
+            else:
+                runs.append((kind, [case]))
+
+        groups = []
+        for (kind, cases) in runs:
+            if kind is None or len(cases) < 2:
+                if groups and groups[-1][0] == self.GROUP_LINEAR:
+                    groups[-1] = (self.GROUP_LINEAR, None, groups[-1][2] + tuple(cases))
+                else:
+                    groups.append((self.GROUP_LINEAR, None, tuple(cases)))
+            elif kind == "eq":
+                table = {}
+                for (cb, nodes, exprs) in cases:
+                    table.setdefault(exprs[0]._value, nodes)
+                groups.append((self.GROUP_EQ, table, tuple(cases)))
+            else:
+                groups.append((self.GROUP_RANGE, self._build_range(kind, cases), tuple(cases)))
+
+        self._groups = tuple(groups)
+
+    def _classify(self, case):
+        """ Determine which kind of lookup table a case can be part of. """
+        (cb, nodes, exprs) = case
+        if not all(isinstance(expr, ValueExpr) for expr in exprs):
+            return None
+
+        values = [expr._value for expr in exprs]
+        kind = self.types[self.cbs.index(cb)]
+
+        if kind == "eq":
+            try:
+                hash(values[0])
+            except TypeError:
+                return None
+            return "eq"
+
+        if kind in ("lt", "le", "gt", "ge", "bt"):
+            if all(isinstance(value, str) for value in values):
+                return "str"
+            if all(isinstance(value, (int, float)) and value == value for value in values):
+                return "num"
+
+        return None
+
+    def _build_range(self, kind, cases):
+        """ Build the bisect table for a run of range cases. """
+
+        points = sorted(set(expr._value for case in cases for expr in case[2]))
+
+        # For a value equal to a boundary just test the cases directly
+        at_point = []
+        for point in points:
+            for (cb, nodes, exprs) in cases:
+                if cb(point, *[expr._value for expr in exprs]):
+                    at_point.append(nodes)
+                    break
+            else:
+                at_point.append(None)
+
+        # Between two boundaries, a value compares the same against every
+        # boundary, so the first matching case can be determined from the
+        # surrounding boundaries.  None means no boundary in that direction.
+        between = []
+        for index in range(len(points) + 1):
+            low = points[index - 1] if index > 0 else None
+            high = points[index] if index < len(points) else None
+
+            for (cb, nodes, exprs) in cases:
+                params = [expr._value for expr in exprs]
+                which = self.types[self.cbs.index(cb)]
+
+                if which in ("lt", "le"):
+                    matched = high is not None and params[0] >= high
+                elif which in ("gt", "ge"):
+                    matched = low is not None and params[0] <= low
+                else:
+                    matched = (low is not None and params[0] <= low and
+                               high is not None and params[1] >= high)
+
+                if matched:
+                    between.append(nodes)
+                    break
+            else:
+                between.append(None)
+
+        types = str if kind == "str" else (int, float)
+        return (types, points, tuple(at_point), tuple(between))
+
+    def _children(self):
+        """ Return the node lists of each case. """
+        return [self._default] + [nodes for (cb, nodes, exprs) in self._cases]
 
 
 class EmitNode(Node):
     """ A node to output some value. """
+    __slots__ = ("_expr",)
 
     def __init__(self, template, line, expr):
         """ Initialize the node. """
         Node.__init__(self, template, line)
         self._expr = expr
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Render the output. """
-        renderer.render(str(self._expr.eval()))
+        renderer.render(str(self._expr.eval(env)))
+
+
+class EscapeEmitNode(EmitNode):
+    """ A node to output a value escaped for HTML. """
+    __slots__ = ()
+
+    def render(self, env, renderer):
+        """ Render the escaped output. """
+        renderer.render(escape(self._expr.eval(env)))
 
 
 class IncludeNode(Node):
     """ A node to include another template. """
+    __slots__ = ("_expr", "_assigns", "_retvar")
 
     def __init__(self, template, line, expr, assigns, retvar):
         """ Initialize the include node. """
         Node.__init__(self, template, line)
         self._expr = expr
-        self._assigns = assigns
+        self._assigns = tuple(assigns)
         self._retvar = retvar
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Actually do the work of including the template. """
+        (template, context) = self._prepare(env)
+        template._render(env, renderer, context, self._retvar)
+
+    def _iter(self, env, renderer):
+        """ Yield the body of the included template. """
+        (template, context) = self._prepare(env)
+        body = template._iter(env, renderer, context, self._retvar)
         try:
-            template = self._env.load_file(
-                str(self._expr.eval()),
+            for nodes in body:
+                yield nodes
+        finally:
+            body.close()
+
+    def _prepare(self, env):
+        """ Load the template and evaluate the context to pass to it. """
+        try:
+            template = env._load(
+                str(self._expr.eval(env)),
                 self._template
             )
         except (IOError, OSError, RestrictedError) as e:
@@ -222,43 +614,45 @@ class IncludeNode(Node):
 
         context = {}
         for (var, expr) in self._assigns:
-            context[var] = expr.eval()
+            context[var] = expr.eval(env)
 
-        template.render(renderer, context, self._retvar)
+        return (template, context)
 
 
 class ReturnNode(Node):
     """ A node to set a return variable. """
+    __slots__ = ("_assigns",)
 
     def __init__(self, template, line, assigns):
         """ Initialize. """
         Node.__init__(self, template, line)
-        self._assigns = assigns
+        self._assigns = tuple(assigns)
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Set the return nodes. """
 
         result = {}
         for (var, expr) in self._assigns:
-            result[var] = expr.eval()
+            result[var] = expr.eval(env)
 
-        self._env.set(":return:", result, Scope.SCOPE_TEMPLATE)
+        env.set(":return:", result, Scope.SCOPE_TEMPLATE)
 
 
 class ExpandNode(Node):
     """ A node to expand variables into the current scope. """
+    __slots__ = ("_expr",)
 
     def __init__(self, template, line, expr):
         """ Initialize """
         Node.__init__(self, template, line)
         self._expr = expr
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Expand the variables. """
 
-        result = self._expr.eval()
+        result = self._expr.eval(env)
         try:
-            self._env.update(result)
+            env.update(result)
         except (KeyError, TypeError, ValueError) as e:
             raise TemplateError(
                 str(e),
@@ -269,23 +663,24 @@ class ExpandNode(Node):
 
 class AssignNode(Node):
     """ Set a variable to a subvariable. """
+    __slots__ = ("_assigns", "_where")
 
     def __init__(self, template, line, assigns, where):
         """ Initialize. """
         Node.__init__(self, template, line)
-        self._assigns = assigns
+        self._assigns = tuple(assigns)
         self._where = where
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Set the value. """
-        env = self._env
 
         for (var, expr) in self._assigns:
-            env.set(var, expr.eval(), self._where)
+            env.set(var, expr.eval(env), self._where)
 
 
 class SectionNode(Node):
     """ A node to redirect template output to a section. """
+    __slots__ = ("_expr", "_nodes")
 
     def __init__(self, template, line, expr):
         """ Initialize. """
@@ -293,84 +688,130 @@ class SectionNode(Node):
         self._expr = expr
         self._nodes = NodeList()
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Redirect output to a section. """
 
-        section = str(self._expr.eval())
+        section = str(self._expr.eval(env))
         renderer.push_section(section)
-        self._nodes.render(renderer)
+        for node in self._nodes:
+            node.render(env, renderer)
         renderer.pop_section()
 
+    def _iter(self, env, renderer):
+        """ Yield the body with output redirected to the section. """
+        section = str(self._expr.eval(env))
+        renderer.push_section(section)
+        yield (self._nodes, renderer)
+        renderer.pop_section()
+
+    def _freeze(self):
+        """ Freeze the nested node list. """
+        self._nodes = freeze_nodes(self._nodes)
+
+    def _children(self):
+        """ Return the nested node list. """
+        return (self._nodes,)
+
 
 class UseSectionNode(Node):
     """ A node to use a section in the output. """
+    __slots__ = ("_expr", "_defer")
 
-    def __init__(self, template, line, expr):
+    def __init__(self, template, line, expr, defer=False):
         """ Initialize. """
         Node.__init__(self, template, line)
         self._expr = expr
+        self._defer = defer
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Render the section to the output. """
 
-        section = str(self._expr.eval())
-        renderer.render(renderer.get_section(section))
+        section = str(self._expr.eval(env))
+        if self._defer:
+            renderer.defer_section(section)
+        else:
+            renderer.render_section(section)
 
 
 class ScopeNode(Node):
     """ Create and remove scopes. """
+    __slots__ = ("_assigns", "_nodes")
 
     def __init__(self, template, line, assigns):
         """ Initialize. """
         Node.__init__(self, template, line)
-        self._assigns = assigns
+        self._assigns = tuple(assigns)
         self._nodes = NodeList()
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Render the scope. """
-        env = self._env
         env._push_scope()
         try:
             for (var, expr) in self._assigns:
-                env.set(var, expr.eval())
+                env.set(var, expr.eval(env))
+
+            for node in self._nodes:
+                node.render(env, renderer)
+        finally:
+            env._pop_scope()
+
+    def _iter(self, env, renderer):
+        """ Yield the body inside a new scope. """
+        env._push_scope()
+        try:
+            for (var, expr) in self._assigns:
+                env.set(var, expr.eval(env))
 
-            self._nodes.render(renderer)
+            yield (self._nodes, renderer)
         finally:
             env._pop_scope()
 
+    def _freeze(self):
+        """ Freeze the nested node list. """
+        self._nodes = freeze_nodes(self._nodes)
+
+    def _children(self):
+        """ Return the nested node list. """
+        return (self._nodes,)
+
 
 class CodeNode(Node):
     """ A node to execute python code. """
+    __slots__ = ("_assigns", "_retvar", "_nodes", "_code")
 
     def __init__(self, template, line, assigns, retvar):
         """ Initialize the include node. """
         Node.__init__(self, template, line)
-        self._assigns = assigns
+        self._assigns = tuple(assigns)
         self._retvar = retvar
         self._nodes = NodeList()
         self._code = None
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Actually do the work of including the template. """
 
         # Check if allowed
-        if not self._env._code_enabled:
+        if not env._code_enabled:
             raise TemplateError(
                 "Use of direct python code not allowed",
                 self._template._filename,
                 self._line
             )
 
-        # Compile the code only once
+        # Compile the code only once, into a function taking the assigns
         if not self._code:
+            from .codecache import compile_code, code_function
+
             # Get the code
-            new_renderer = StringRenderer()
-            self._nodes.render(new_renderer)
-            code = new_renderer.get()
+            renderer.push_capture()
+            for node in self._nodes:
+                node.render(env, renderer)
+            code = renderer.pop_capture()
 
             # Compile it
+            params = tuple(var for (var, expr) in self._assigns)
             try:
-                self._code = compile(code, "<string>", "exec")
+                code = compile_code(code, params)
             except Exception as e:
                 raise TemplateError(
                     str(e),
@@ -378,13 +819,11 @@ class CodeNode(Node):
                     self._line
                 )
 
-        # Execute the code
-        locals = {}
-        for (var, expr) in self._assigns:
-            locals[var] = expr.eval()
+            self._code = code_function(code, params)
 
+        # Execute the code
         try:
-            exec(self._code, locals, locals)
+            locals = self._code(*[expr.eval(env) for (var, expr) in self._assigns])
         except Exception as e:
             raise TemplateError(
                 str(e),
@@ -394,53 +833,97 @@ class CodeNode(Node):
 
         # Handle return values
         if self._retvar:
-            self._env.set(self._retvar, locals)
+            env.set(self._retvar, locals)
+
+    def _freeze(self):
+        """ Freeze the nested node list. """
+        self._nodes = freeze_nodes(self._nodes)
+
+    def _children(self):
+        """ Return the nested node list. """
+        return (self._nodes,)
 
 
 class VarNode(Node):
     """ Capture output into a variable. """
+    __slots__ = ("_var", "_nodes", "_safe")
 
-    def __init__(self, template, line, var):
-        """ Initialize. """
+    def __init__(self, template, line, var, safe=False):
+        """ Initialize.  If safe, the output is already escaped. """
         Node.__init__(self, template, line)
         self._var = var
         self._nodes = NodeList()
+        self._safe = safe
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Render the results and capture into a variable. """
 
-        new_renderer = StringRenderer()
-        self._nodes.render(new_renderer)
-        self._env.set(self._var, new_renderer.get())
+        renderer.push_capture()
+        for node in self._nodes:
+            node.render(env, renderer)
+        self._set(env, renderer.pop_capture())
+
+    def _iter(self, env, renderer):
+        """ Yield the body to be captured. """
+        renderer.push_capture()
+        yield (self._nodes, renderer)
+        self._set(env, renderer.pop_capture())
+
+    def _set(self, env, value):
+        """ Set the captured value. """
+        if self._safe:
+            value = SafeString(value)
+        env.set(self._var, value)
+
+    def _freeze(self):
+        """ Freeze the nested node list. """
+        self._nodes = freeze_nodes(self._nodes)
+
+    def _children(self):
+        """ Return the nested node list. """
+        return (self._nodes,)
 
 class ErrorNode(Node):
     """ Raise an error from the template. """
+    __slots__ = ("_expr",)
 
     def __init__(self, template, line, expr):
         """ Initialize. """
         Node.__init__(self, template, line)
         self._expr = expr
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Raise the error. """
         raise RaisedError(
-            str(self._expr.eval()),
+            str(self._expr.eval(env)),
             self._template._filename,
             self._line
         )
 
 class ImportNode(Node):
     """ Import a library to a variable in the current scope. """
+    __slots__ = ("_assigns", "_literal", "_cache")
+
     def __init__(self, template, line, assigns):
         Node.__init__(self, template, line)
-        self._assigns = assigns
+        self._assigns = tuple(assigns)
+        self._literal = all(isinstance(expr, ValueExpr) for (var, expr) in self._assigns)
+        self._cache = None
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Do the import. """
-        env = self._env
 
+        # Imports of literal names are kept for environments with the same
+        # importers
+        cache = self._cache
+        if cache is not None and cache[0] is env._importers:
+            for (var, imp) in cache[1]:
+                env.set(var, imp)
+            return
+
+        imports = []
         for (var, expr) in self._assigns:
-            name = expr.eval()
+            name = expr.eval(env)
             try:
                 imp = env.load_import(name)
                 env.set(var, imp)
@@ -450,31 +933,36 @@ class ImportNode(Node):
                     self._template._filename,
                     self._line
                 )
+            imports.append((var, imp))
+
+        if self._literal:
+            self._cache = (env._importers, tuple(imports))
 
 class DoNode(Node):
     """ Evaluate expressions and discard the results. """
+    __slots__ = ("_nodes",)
 
     def __init__(self, template, line, nodes):
         """ Initialize. """
         Node.__init__(self, template, line)
-        self._nodes = nodes
+        self._nodes = tuple(nodes)
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Set the value. """
         for node in self._nodes:
-            node.eval()
+            node.eval(env)
 
 class UnsetNode(Node):
     """ Unset variable at the current scope rsults. """
+    __slots__ = ("_varlist",)
 
     def __init__(self, template, line, varlist):
         """ Initialize. """
         Node.__init__(self, template, line)
-        self._varlist = varlist
+        self._varlist = tuple(varlist)
 
-    def render(self, renderer):
+    def render(self, env, renderer):
         """ Set the value. """
-        env = self._env
         for item in self._varlist:
             env.unset(item)
 
@@ -6,12 +6,19 @@ __license__     = "Apache License 2.0"
 
 
 import re
+import operator
+
+try:
+    from sys import intern
+except ImportError:
+    pass # Python 2 has intern as a builtin
 
 
 from .errors import *
 from .nodes import *
 from .expr import *
 from .scope import *
+from .markup import escape
 
 
 class Token(object):
@@ -33,6 +40,7 @@ class Token(object):
     TYPE_COMMA          = 15
     TYPE_EQUAL          = 16
     TYPE_WORD           = 17
+    TYPE_OPERATOR       = 18
 
     WS_NONE = 0
     WS_TRIMTONL = 1
@@ -40,6 +48,8 @@ class Token(object):
     WS_ADDNL = 3
     WS_ADDSP = 4
 
+    __slots__ = ("_type", "_line", "_value")
+
     def __init__(self, type, line, value=None):
         """ Initialize a token. """
         self._type = type
@@ -81,6 +91,22 @@ class Tokenizer(object):
         "*": Token.WS_ADDSP
     }
 
+    _operators = (
+        "==", "!=", "<=", ">=", "//",
+        "+", "-", "*", "/", "%", "<", ">"
+    )
+    _operator_chars = "=!<>/+-*%"
+
+    # Tokens after which a "-" or "+" is a binary operator and not a sign
+    _value_ends = (
+        Token.TYPE_STRING,
+        Token.TYPE_INTEGER,
+        Token.TYPE_FLOAT,
+        Token.TYPE_END_LIST,
+        Token.TYPE_END_FUNC,
+        Token.TYPE_WORD
+    )
+
     def __init__(self, text, filename):
         """ Initialze the tokenizer. """
         self._text = text
@@ -197,6 +223,32 @@ class Tokenizer(object):
                 pos += 1
                 continue
 
+            # Ending tag
+            tag = self._text[pos:pos + 2]
+            wscontrol = self._ws_map.get(ch, Token.WS_NONE)
+            if wscontrol != Token.WS_NONE:
+                tag = self._text[pos + 1:pos + 3]
+
+            if tag in ("#}", "%}", "}}"):
+                type = self._tag_map[tag]
+                token = Token(type, self._line, wscontrol)
+                self._tokens.append(token)
+                self._mode = self.MODE_TEXT
+                pos += 3 if wscontrol != Token.WS_NONE else 2
+                break
+
+            # Number with a sign
+            if ch in ("-", "+") and self._text[pos + 1:pos + 2] in self._digit and not self._after_value():
+                pos = self._parse_number(pos)
+                continue
+
+            # Operators
+            if ch in self._operator_chars:
+                op = self._parse_operator(pos)
+                if op:
+                    pos += len(op)
+                    continue
+
             # Single symbols
             if ch in self._symbol_map:
                 token = Token(self._symbol_map[ch], self._line)
@@ -220,32 +272,13 @@ class Tokenizer(object):
                 pos = self._parse_word(pos)
                 continue
 
-            # Ending tag
-            if ch in ("-", "^", "+", "*", "%", "#", "}"):
-
-                # Check for number first if starts with "-" or "+"
-                if ch in ("-", "+") and self._text[pos + 1:pos + 2] in self._digit:
-                    pos = self._parse_number(pos)
-                    continue
-
-                wscontrol = self._ws_map.get(ch, Token.WS_NONE)
-                if wscontrol != Token.WS_NONE:
-                    pos += 1
-
-                tag = self._text[pos:pos + 2]
-                if not tag in ("#}", "%}", "}}"):
-                    raise SyntaxError(
-                        "Invalid tag: {0}".format(tag),
-                        self._filename,
-                        self._line
-                    )
-
-                type = self._tag_map[tag]
-                token = Token(type, self._line, wscontrol)
-                self._tokens.append(token)
-                self._mode = self.MODE_TEXT
-                pos += 2
-                break
+            # Invalid ending tag
+            if ch in ("^", "#", "}"):
+                raise SyntaxError(
+                    "Invalid tag: {0}".format(self._text[pos:pos + 2]),
+                    self._filename,
+                    self._line
+                )
 
             # Unknown character in input
             raise SyntaxError(
@@ -257,6 +290,27 @@ class Tokenizer(object):
         # end while loop
         return pos
 
+    def _parse_operator(self, start):
+        """ Parse an operator if one is found, returning it or None. """
+        for op in self._operators:
+            if self._text.startswith(op, start):
+                token = Token(Token.TYPE_OPERATOR, self._line, op)
+                self._tokens.append(token)
+                return op
+
+        return None
+
+    def _after_value(self):
+        """ Determine if the last token ends a value. """
+        if not self._tokens:
+            return False
+
+        token = self._tokens[-1]
+        if token._type == Token.TYPE_WORD:
+            return not token._value in TemplateParser.WORD_OPERATORS
+
+        return token._type in self._value_ends
+
     def _parse_number(self, start):
         """ Parse a number. """
         result = []
@@ -328,7 +382,7 @@ class Tokenizer(object):
                 self._line += 1
 
         if not end:
-            raise SyntaxError("Unclosed string", self._line)
+            raise SyntaxError("Unclosed string", self._filename, self._line)
 
         token = Token(Token.TYPE_STRING, self._line, "".join(result))
         self._tokens.append(token)
@@ -359,6 +413,36 @@ class TemplateParser(object):
     AUTOSTRIP_STRIP = 1
     AUTOSTRIP_TRIM = 2
 
+    WORD_OPERATORS = ("and", "or", "not", "in")
+
+    _compare_ops = {
+        "==": operator.eq,
+        "!=": operator.ne,
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "in": lambda a, b: a in b,
+        "not in": lambda a, b: a not in b
+    }
+
+    _add_ops = {
+        "+": operator.add,
+        "-": operator.sub
+    }
+
+    _mul_ops = {
+        "*": operator.mul,
+        "/": operator.truediv,
+        "//": operator.floordiv,
+        "%": operator.mod
+    }
+
+    _unary_ops = {
+        "-": operator.neg,
+        "+": operator.pos
+    }
+
     def __init__(self, template, text):
         """ Initialize the parser. """
 
@@ -377,6 +461,7 @@ class TemplateParser(object):
         self._pre_ws_control = Token.WS_NONE
         self._autostrip = self.AUTOSTRIP_NONE
         self._autostrip_stack = []
+        self._autoescape = template._env._autoescape
 
     def _get_token(self, pos, errmsg="Expected token"):
         """ Get a token at a position. """
@@ -417,7 +502,11 @@ class TemplateParser(object):
                 self._ops_stack[-1][1]
             )
 
-        return self._nodes
+        nodes = freeze_nodes(self._nodes)
+        if self._template._memoize is not None:
+            self._check_memoize(nodes)
+
+        return nodes
 
     def _parse_body(self):
         """ Parse the entire body. """
@@ -546,6 +635,12 @@ class TemplateParser(object):
             self._autostrip = self.AUTOSTRIP_TRIM
         elif action == "no_autostrip":
             self._autostrip = self.AUTOSTRIP_NONE
+        elif action == "memoize":
+            pos = self._parse_action_memoize(pos)
+        elif action == "autoescape":
+            self._autoescape = True
+        elif action == "no_autoescape":
+            self._autoescape = False
         else:
             raise SyntaxError(
                 "Unknown action tag: {0}".format(action),
@@ -641,7 +736,12 @@ class TemplateParser(object):
 
         (expr, pos) = self._parse_expr(pos + 1)
 
-        node = ForNode(self._template, line, var, cvar, expr)
+        loop = None
+        token = self._get_token(pos)
+        if token._type == Token.TYPE_WORD and token._value == "loop":
+            (loop, pos) = self._parse_topvar(pos + 1)
+
+        node = ForNode(self._template, line, var, cvar, expr, loop)
         self._ops_stack.append(("for", line))
         self._stack[-1].append(node)
         self._stack.append(node._nodes)
@@ -720,6 +820,39 @@ class TemplateParser(object):
 
         return pos
 
+    def _parse_action_memoize(self, start):
+        """ Parse a memoize statement for the template. """
+        line = self._token._line
+
+        if self._template._memoize is not None:
+            raise SyntaxError(
+                "Duplicate memoize tag",
+                self._template._filename,
+                line
+            )
+
+        (varlist, pos) = self._parse_multi_var(start, Token.TYPE_END_ACTION)
+        if not varlist:
+            raise SyntaxError(
+                "Memoize requires the variables the output depends on",
+                self._template._filename,
+                line
+            )
+        self._template._memoize = tuple(tuple(var) for var in varlist)
+
+        return pos
+
+    def _check_memoize(self, nodes):
+        """ Reject the use of sections in a memoized template. """
+        for top in nodes:
+            for node in top.walk():
+                if isinstance(node, (SectionNode, UseSectionNode)):
+                    raise SyntaxError(
+                        "Sections can not be used in a memoized template",
+                        self._template._filename,
+                        node._line
+                    )
+
     def _parse_action_scope(self, start):
         """ Parse a scope statement. """
         line = self._token._line
@@ -821,7 +954,13 @@ class TemplateParser(object):
 
         (expr, pos) = self._parse_expr(start)
 
-        node = UseSectionNode(self._template, line, expr)
+        defer = False
+        token = self._get_token(pos)
+        if token._type == Token.TYPE_WORD and token._value == "defer":
+            defer = True
+            pos += 1
+
+        node = UseSectionNode(self._template, line, expr, defer)
         self._stack[-1].append(node)
 
         return pos
@@ -860,7 +999,7 @@ class TemplateParser(object):
         nodes = self._template._defines.get(token._value, None)
         if nodes is None:
             raise UnknownDefineError(
-                name,
+                token._value,
                 self._template._filename,
                 line
             )
@@ -875,7 +1014,7 @@ class TemplateParser(object):
 
         (var, pos) = self._parse_topvar(start)
 
-        node = VarNode(self._template, line, var)
+        node = VarNode(self._template, line, var, self._autoescape)
         self._ops_stack.append(("var", line))
         self._stack[-1].append(node)
         self._stack.append(node._nodes)
@@ -980,16 +1119,191 @@ class TemplateParser(object):
         pos = self._parse_tag_ending(pos, Token.TYPE_END_EMITTER)
 
         if isinstance(expr, ValueExpr):
-            node = TextNode(self._template, line, str(expr.eval()))
+            if self._autoescape:
+                node = TextNode(self._template, line, escape(expr._value))
+            else:
+                node = TextNode(self._template, line, str(expr._value))
+        elif self._autoescape:
+            node = EscapeEmitNode(self._template, line, expr)
         else:
             node = EmitNode(self._template, line, expr)
         self._stack[-1].append(node)
         return pos
         
     def _parse_expr(self, start):
-        """ Parse an expression and return (node, pos) """
+        """ Parse an expression and return (node, pos)
+
+            Operators from lowest to highest precedence are:
+                or
+                and
+                not
+                ==, !=, <, <=, >, >=, in, not in
+                +, -
+                *, /, //, %
+                unary -, unary +
+        """
+        return self._parse_expr_or(start)
+
+    def _get_operator(self, pos):
+        """ Return (op, nextpos) if the token at pos is an operator. """
+        token = self._get_token(pos)
+        if token._type == Token.TYPE_OPERATOR:
+            return (token._value, pos + 1)
+
+        if token._type == Token.TYPE_WORD and token._value in self.WORD_OPERATORS:
+            if token._value == "not":
+                next = self._tokens[pos + 1] if pos + 1 < len(self._tokens) else None
+                if next and next._type == Token.TYPE_WORD and next._value == "in":
+                    return ("not in", pos + 2)
+            return (token._value, pos + 1)
+
+        return (None, pos)
+
+    def _fold(self, node, operands):
+        """ Evaluate an operator over literal values at parse time. """
+        if all(isinstance(operand, ValueExpr) for operand in operands):
+            try:
+                return ValueExpr(self._template, node._line, node.eval(self._template._env))
+            except Exception:
+                pass # Leave the error to be raised when rendering
+
+        return node
+
+    def _fold_call(self, node):
+        """ Evaluate a call to a pure library function with literal arguments
+            at parse time.  The function is looked up in the global scope of
+            the environment as it is when the template is loaded.  The result
+            is only used when the same function is found while rendering.
+        """
+        if not all(isinstance(param, ValueExpr) for param in node._nodes):
+            return node
+
+        try:
+            fn = self._template._env._get_global(node._var)
+        except KeyError:
+            return node
+
+        if not getattr(fn, "_template_pure", False):
+            return node
+
+        try:
+            value = fn(*[param._value for param in node._nodes])
+        except Exception:
+            return node # Leave the error to be raised when rendering
+
+        node._folded = (fn, value)
+        return node
+
+    def _parse_expr_or(self, start):
+        """ Parse an or expression. """
+        (node, pos) = self._parse_expr_and(start)
+
+        while True:
+            (op, next) = self._get_operator(pos)
+            if op != "or":
+                return (node, pos)
+
+            line = self._token._line
+            (right, pos) = self._parse_expr_and(next)
+            node = self._fold(OrExpr(self._template, line, node, right), (node, right))
+
+    def _parse_expr_and(self, start):
+        """ Parse an and expression. """
+        (node, pos) = self._parse_expr_not(start)
+
+        while True:
+            (op, next) = self._get_operator(pos)
+            if op != "and":
+                return (node, pos)
+
+            line = self._token._line
+            (right, pos) = self._parse_expr_not(next)
+            node = self._fold(AndExpr(self._template, line, node, right), (node, right))
+
+    def _parse_expr_not(self, start):
+        """ Parse a not expression. """
+        (op, next) = self._get_operator(start)
+        if op != "not":
+            return self._parse_expr_compare(start)
+
+        line = self._token._line
+        (expr, pos) = self._parse_expr_not(next)
+        node = UnaryExpr(self._template, line, operator.not_, expr)
+        return (self._fold(node, (expr,)), pos)
+
+    def _parse_expr_compare(self, start):
+        """ Parse a possibly chained comparison. """
+        (first, pos) = self._parse_expr_add(start)
+
+        line = self._token._line
+        ops = []
+        while True:
+            (op, next) = self._get_operator(pos)
+            if not op in self._compare_ops:
+                break
+
+            (expr, pos) = self._parse_expr_add(next)
+            ops.append((self._compare_ops[op], expr))
+
+        if not ops:
+            return (first, pos)
+
+        operands = [first] + [expr for (fn, expr) in ops]
+        if len(ops) == 1:
+            node = BinaryExpr(self._template, line, ops[0][0], first, ops[0][1])
+        else:
+            node = CompareExpr(self._template, line, first, ops)
+
+        return (self._fold(node, operands), pos)
+
+    def _parse_expr_add(self, start):
+        """ Parse addition and subtraction. """
+        (node, pos) = self._parse_expr_mul(start)
+
+        while True:
+            (op, next) = self._get_operator(pos)
+            if not op in self._add_ops:
+                return (node, pos)
+
+            line = self._token._line
+            (right, pos) = self._parse_expr_mul(next)
+            node = BinaryExpr(self._template, line, self._add_ops[op], node, right)
+            node = self._fold(node, (node._left, right))
+
+    def _parse_expr_mul(self, start):
+        """ Parse multiplication and division. """
+        (node, pos) = self._parse_expr_unary(start)
+
+        while True:
+            (op, next) = self._get_operator(pos)
+            if not op in self._mul_ops:
+                return (node, pos)
+
+            line = self._token._line
+            (right, pos) = self._parse_expr_unary(next)
+            node = BinaryExpr(self._template, line, self._mul_ops[op], node, right)
+            node = self._fold(node, (node._left, right))
+
+    def _parse_expr_unary(self, start):
+        """ Parse unary operators. """
+        (op, next) = self._get_operator(start)
+        if not op in self._unary_ops:
+            return self._parse_expr_value(start)
+
+        line = self._token._line
+        (expr, pos) = self._parse_expr_unary(next)
+        node = UnaryExpr(self._template, line, self._unary_ops[op], expr)
+        return (self._fold(node, (expr,)), pos)
+
+    def _parse_expr_value(self, start):
+        """ Parse a single value and return (node, pos) """
 
         token = self._get_token(start)
+        if token._type == Token.TYPE_START_FUNC:
+            (node, pos) = self._parse_expr(start + 1)
+            self._get_expected_token(pos, Token.TYPE_END_FUNC, "Expected ')'")
+            return (node, pos + 1)
+
         if token._type in (Token.TYPE_STRING, Token.TYPE_FLOAT, Token.TYPE_INTEGER):
             node = ValueExpr(self._template, token._line, token._value)
             return (node, start + 1)
@@ -1002,7 +1316,7 @@ class TemplateParser(object):
         if next._type == Token.TYPE_START_FUNC:
             (nodes, pos) = self._parse_multi_expr(pos + 1, Token.TYPE_END_FUNC)
             pos += 1 # skip past ")"
-            node = FuncExpr(self._template, next._line, var, nodes)
+            node = self._fold_call(FuncExpr(self._template, next._line, var, nodes))
         elif next._type == Token.TYPE_START_LIST:
             (nodes, pos) = self._parse_multi_expr(pos + 1, Token.TYPE_END_LIST)
             pos += 1 # skip past "]"
@@ -1018,7 +1332,7 @@ class TemplateParser(object):
         pos += 1 # skip past "]"
 
         if nodes and all(isinstance(node, ValueExpr) for node in nodes):
-            node = ValueExpr(self._template, nodes[0]._line, [node.eval() for node in nodes])
+            node = ValueExpr(self._template, nodes[0]._line, [node._value for node in nodes])
         else:
             node = ListExpr(self._template, self._token._line, nodes)
         return (node, pos)
@@ -1118,6 +1432,9 @@ class TemplateParser(object):
                     token._line
                 )
 
+        # Variable names repeat throughout templates, share a single copy
+        parts = [intern(part) for part in parts]
+
         if allow_dots:
             result = parts
         else:
@@ -0,0 +1,97 @@
+""" Validate and warm up an entire tree of templates. """
+
+__author__      = "Brian Allen Vanderburg II"
+__copyright__   = "Copyright 2016"
+__license__     = "Apache License 2.0"
+
+__all__ = ["precompile"]
+
+
+from . import errors as _errors
+from .errors import *
+from .env import Environment
+from .loaders import SearchPathLoader
+
+
+def _check_templates(job):
+    """ Parse a batch of templates and return any errors found.  Errors are
+        returned as (class name, message, filename, line) tuples, since the
+        errors themselves can not always be pickled.
+    """
+    (paths, names) = job
+
+    env = Environment(loader=SearchPathLoader(paths))
+    errors = []
+
+    for name in names:
+        try:
+            try:
+                env.load_file(name)
+            except (IOError, OSError) as e:
+                raise TemplateError(str(e), name, 0)
+        except Error as e:
+            errors.append((
+                type(e).__name__,
+                str(e),
+                getattr(e, "filename", None),
+                getattr(e, "line", None)
+            ))
+
+    return errors
+
+
+def _rebuild_error(kind, message, filename, line):
+    """ Recreate an error returned by _check_templates. """
+    cls = getattr(_errors, kind, Error)
+    error = cls.__new__(cls)
+    Error.__init__(error, message)
+    if issubclass(cls, TemplateError):
+        error.filename = filename
+        error.line = line
+
+    return error
+
+
+def precompile(paths, workers=None, env=None, extensions=(".tmpl",)):
+    """ Parse every template found under the search paths.
+
+        The templates are tokenized and parsed in a pool of worker processes.
+        All errors found are collected and raised as a single PrecompileError.
+        If env is given, the templates are then loaded into the environment so
+        its loader cache is warm.  Return the list of template names found.
+    """
+
+    if not isinstance(paths, (tuple, list)):
+        paths = [paths]
+
+    names = SearchPathLoader(paths).list_templates(extensions)
+
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+
+    workers = max(1, min(workers, len(names)))
+    jobs = [(paths, names[i::workers]) for i in range(workers)]
+
+    if workers == 1:
+        results = [_check_templates(job) for job in jobs]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_check_templates, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    errors = [_rebuild_error(*error) for result in results for error in result]
+    if errors:
+        errors.sort(key=lambda e: (getattr(e, "filename", "") or "", getattr(e, "line", 0)))
+        raise PrecompileError(errors)
+
+    if env:
+        for name in names:
+            env.load_file(name)
+
+    return names
+
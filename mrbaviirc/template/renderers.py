@@ -4,33 +4,150 @@ __author__      = "Brian Allen Vanderburg II"
 __copyright__   = "Copyright 2016"
 __license__     = "Apache License 2.0"
 
+__all__ = ["Renderer", "StreamRenderer", "StringRenderer", "BytesRenderer"]
+
+import codecs
+import os
+
+
+def _encode(content):
+    """ Encode text for a spilled section.  Byte strings on Python 2 are
+        written as they are.
+    """
+    if isinstance(content, bytes):
+        return content
+    return content.encode("utf-8")
+
+
+class Section(object):
+    """ The contents of a section.  Once the contents grow beyond spill_size
+        characters they are moved to a temporary file.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, spill_size=None):
+        """ Initialize the section. """
+        self._buffer = [] # A list, since io.StringIO rejects str on Python 2
+        self._joined = None
+        self._size = 0
+        self._spill_size = spill_size
+        self._file = None
+
+    def append(self, content):
+        """ Append content to the section. """
+        if self._file is not None:
+            self._file.write(_encode(content))
+            return
+
+        self._buffer.append(content)
+        self._joined = None
+        self._size += len(content)
+        if self._spill_size is not None and self._size > self._spill_size:
+            self._spill()
+
+    def _spill(self):
+        """ Move the contents to a temporary file. """
+        import tempfile
+        self._file = tempfile.TemporaryFile("w+b")
+        self._file.write(_encode("".join(self._buffer)))
+        self._buffer = None
+        self._joined = None
+
+    def chunks(self):
+        """ Yield the contents in pieces of limited size. """
+        if self._file is None:
+            yield self.get()
+            return
+
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        self._file.flush()
+        self._file.seek(0)
+        try:
+            while True:
+                data = self._file.read(self.CHUNK_SIZE)
+                chunk = decoder.decode(data, not data)
+                if chunk:
+                    yield chunk
+                if not data:
+                    break
+        finally:
+            self._file.seek(0, 2)
+
+    def get(self):
+        """ Return the entire contents. """
+        if self._file is None:
+            # Joined contents are kept until the section is appended to, and
+            # replace the pieces so they are not joined again
+            if self._joined is None:
+                self._joined = "".join(self._buffer)
+                self._buffer[:] = [self._joined]
+            return self._joined
+
+        return "".join(self.chunks())
+
+    def close(self):
+        """ Close the temporary file of a spilled section.  Its contents are
+            no longer available afterward.
+        """
+        if self._file is not None:
+            self._file.close()
+
+
+class _Deferred(object):
+    """ A placeholder in the output for the contents of a section. """
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        """ Initialize the placeholder. """
+        self.name = name
+
 
 class Renderer(object):
     """ A renderer takes content and renders it in some fashion. """
 
-    def __init__(self):
-        """ Initialize the renderer. """
+    def __init__(self, spill_size=None):
+        """ Initialize the renderer.  Sections larger than spill_size
+            characters are kept in temporary files.
+        """
         self._sections = {}
-        self._cursection = []
-        pass
+        self._targets = [] # Sections and captures being rendered to
+        self._captures = [] # Spare capture buffers
+        self._spill_size = spill_size
+        self._section_uses = 0 # Counted for IncrementalRender
 
     def render(self, content):
         """ Render the content. """
-        if self._cursection:
-            section = self._cursection[-1]
-            self._sections[section].append(content)
+        if self._targets:
+            self._targets[-1].append(content)
             return True
         else:
             return False
 
+    def push_capture(self):
+        """ Capture rendered content until pop_capture is called. """
+        captures = self._captures
+        self._targets.append(captures.pop() if captures else [])
+
+    def pop_capture(self):
+        """ Stop capturing and return the captured content. """
+        buffer = self._targets.pop()
+        result = "".join(buffer)
+        del buffer[:]
+        self._captures.append(buffer)
+        return result
+
     def push_section(self, name):
         """ Set a named section to render to. """
-        self._sections.setdefault(name, [])
-        self._cursection.append(name)
+        self._section_uses += 1
+        section = self._sections.get(name)
+        if section is None:
+            section = self._sections[name] = Section(self._spill_size)
+        self._targets.append(section)
 
     def pop_section(self):
         """ Return rendering to the previous section or default. """
-        self._cursection.pop()
+        self._targets.pop()
 
     def get_sections(self):
         """ Return all known sections. """
@@ -39,41 +156,208 @@ class Renderer(object):
     def get_section(self, name):
         """ Return the contents of a particular section. """
         if name in self._sections:
-            return "".join(self._sections[name])
+            return self._sections[name].get()
 
         return ""
 
+    def render_section(self, name):
+        """ Render the contents of a section a piece at a time. """
+        self._section_uses += 1
+        section = self._sections.get(name)
+        if section is None:
+            return
+
+        if self._targets and self._targets[-1] is section:
+            # Rendering a section into itself, take the contents first
+            self.render(section.get())
+            return
+
+        for chunk in section.chunks():
+            self.render(chunk)
+
+    def render_static(self, node):
+        """ Render the text of a TextNode. """
+        self.render(node._text)
+
+    def defer_section(self, name):
+        """ Render the contents of a section once rendering is finished, so
+            content added to the section later is included.  While rendering
+            to a section or capturing the contents are rendered immediately.
+        """
+        self._section_uses += 1
+        if self._targets or not self._defer(name):
+            self.render_section(name)
+
+    def _defer(self, name):
+        """ Add a placeholder to the output.  Return False if unsupported. """
+        return False
+
+    def finish(self):
+        """ Complete any deferred output. """
+        self.close()
+
+    def close(self):
+        """ Close the temporary files of spilled sections. """
+        for section in self._sections.values():
+            section.close()
+
 
 class StreamRenderer(Renderer):
     """ Render to a given stream. """
 
-    def __init__(self, stream):
+    def __init__(self, stream, spill_size=None):
         """ Initialize the stream. """
-        Renderer.__init__(self)
+        Renderer.__init__(self, spill_size)
         self._stream = stream
+        self._pending = None
 
     def render(self, content):
         """ Render to the stream. """
         if not Renderer.render(self, content):
-            self._stream.write(content)
+            if self._pending is None:
+                self._stream.write(content)
+            else:
+                self._pending.append(content)
+
+    def _defer(self, name):
+        """ Hold back output from the first placeholder until finished. """
+        if self._pending is None:
+            self._pending = []
+        self._pending.append(_Deferred(name))
+        return True
+
+    def finish(self):
+        """ Write the held back output with the placeholders filled in. """
+        pending = self._pending
+        if pending is not None:
+            self._pending = None
+            for item in pending:
+                if isinstance(item, _Deferred):
+                    self.render_section(item.name)
+                else:
+                    self._stream.write(item)
+
+        self.close()
 
 
 class StringRenderer(Renderer):
     """ Render to a string. """
 
-    def __init__(self):
+    def __init__(self, spill_size=None):
         """ Initialize the renderer. """
-        Renderer.__init__(self)
+        Renderer.__init__(self, spill_size)
         self._buffer = []
+        self._deferred = False
 
     def render(self, content):
         """ Render the content to the buffer. """
         if not Renderer.render(self, content):
             self._buffer.append(content)
 
+    def _defer(self, name):
+        """ Add a placeholder to the buffer. """
+        self._buffer.append(_Deferred(name))
+        self._deferred = True
+        return True
+
+    def finish(self):
+        """ Fill in the placeholders in the buffer. """
+        if self._deferred:
+            self._deferred = False
+            self._buffer = [
+                self.get_section(item.name) if isinstance(item, _Deferred) else item
+                for item in self._buffer
+            ]
+
+        self.close()
+
     def get(self):
         """ Get the buffer. """
+        self.finish()
         return "".join(self._buffer)
 
 
+class BytesRenderer(Renderer):
+    """ Render encoded output to a binary file, socket or file descriptor. """
+
+    def __init__(self, sink, encoding="utf-8", buffer_size=65536, spill_size=None):
+        """ Initialize the renderer.  Output is collected in a buffer and
+            written whenever it grows beyond buffer_size bytes.
+        """
+        Renderer.__init__(self, spill_size)
+        self._encoding = encoding
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._pending = None
+
+        if isinstance(sink, int):
+            self._write = lambda data: self._write_fd(sink, data)
+        elif hasattr(sink, "sendall"):
+            self._write = sink.sendall
+        else:
+            self._write = sink.write
+
+    @staticmethod
+    def _write_fd(fd, data):
+        """ Write all data to a file descriptor. """
+        data = memoryview(data)
+        while data:
+            data = data[os.write(fd, data):]
+
+    def render(self, content):
+        """ Encode the content to the buffer. """
+        if not Renderer.render(self, content):
+            self._output(content.encode(self._encoding))
+
+    def render_static(self, node):
+        """ Render the text of a TextNode using its cached encoding. """
+        if self._targets:
+            Renderer.render(self, node._text)
+        else:
+            self._output(node.encoded(self._encoding))
+
+    def _output(self, data):
+        """ Add encoded data to the output. """
+        if self._pending is not None:
+            self._pending.append(data)
+            return
+
+        buffer = self._buffer
+        if len(data) >= self._buffer_size:
+            # Write large pieces directly instead of copying them
+            if buffer:
+                self.flush()
+            self._write(data)
+            return
+
+        buffer += data
+        if len(buffer) >= self._buffer_size:
+            self.flush()
+
+    def _defer(self, name):
+        """ Hold back output from the first placeholder until finished. """
+        if self._pending is None:
+            self._pending = []
+        self._pending.append(_Deferred(name))
+        return True
+
+    def flush(self):
+        """ Write out the buffered output. """
+        if self._buffer:
+            # The sink gets its own copy, so the buffer can be reused
+            self._write(bytes(self._buffer))
+            del self._buffer[:]
+
+    def finish(self):
+        """ Write any held back output and flush the buffer. """
+        pending = self._pending
+        self._pending = None
+        if pending is not None:
+            for item in pending:
+                if isinstance(item, _Deferred):
+                    self.render_section(item.name)
+                else:
+                    self._output(item)
 
+        self.flush()
+        self.close()
@@ -4,6 +4,8 @@ __author__      = "Brian Allen Vanderburg II"
 __copyright__   = "Copyright 2016"
 __license__     = "Apache License 2.0"
 
+__all__ = ["Scope", "LazyValue"]
+
 
 class Scope(object):
     """ Represent the different variable levels at the current scope. """
@@ -12,11 +14,11 @@ class Scope(object):
     SCOPE_TEMPLATE = 2
     SCOPE_PRIVATE = 3
 
-    def __init__(self, parent=None, template=False):
+    def __init__(self, parent=None, template=False, local=None):
         """ Initialize the current scope. """
 
         # We always have the local scope variables
-        self._local = {}
+        self._local = local if local is not None else {}
 
         # Private variables can only be accessed from the scope that set them
         self._private = {}
@@ -34,3 +36,25 @@ class Scope(object):
             self._global = self._local
             self._template = self._local
 
+
+
+class LazyValue(object):
+    """ A value that is only computed when a template first accesses it.
+
+        The function is called with no arguments the first time the value is
+        needed and the result is kept for any later access.
+    """
+    __slots__ = ("_fn", "_value")
+
+    def __init__(self, fn):
+        """ Initialize with the function that computes the value. """
+        self._fn = fn
+        self._value = None
+
+    def get(self):
+        """ Return the value, computing it if needed. """
+        if self._fn is not None:
+            self._value = self._fn()
+            self._fn = None
+
+        return self._value
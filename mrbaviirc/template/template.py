@@ -6,9 +6,27 @@ __license__     = "Apache License 2.0"
 
 
 import os
+import copy
+import threading
+from collections import OrderedDict
 
 from .errors import *
 from .parser import TemplateParser
+from .nodes import IncludeNode, render_iterative
+from .expr import ValueExpr
+from .metrics import perf_counter
+
+
+_MISSING = object()
+
+
+def _typed(value):
+    """ Pair a value, and the items of tuples, with their types, since equal
+        values of different types such as 1 and True may render differently.
+    """
+    if isinstance(value, tuple):
+        return (type(value), tuple(_typed(item) for item in value))
+    return (type(value), value)
 
 
 class Template(object):
@@ -49,6 +67,9 @@ class Template(object):
         {%- ... %}
     """
 
+    # Number of outputs kept for a template using {% memoize %}
+    MEMOIZE_SIZE = 256
+
     def __init__(self, env, text, filename):
         """ Initialize a template with context variables. """
         
@@ -59,14 +80,52 @@ class Template(object):
 
         self._defines = {}
         self._private = {}
+        self._memoize = None
+        self._memo_cache = None
+        self._memo_lock = None
 
         # Parse the template
         parser = TemplateParser(self, text)
         self._nodes = parser.parse()
 
-    def render(self, renderer, context=None, retvar=None):
-        """ Render the template. """
-        env = self._env
+        if self._memoize is not None:
+            # Shared by every environment and thread using the template
+            self._memo_cache = OrderedDict()
+            self._memo_lock = threading.Lock()
+
+    def _includes(self):
+        """ Return the names of templates included with a literal name. """
+        result = []
+        for top in self._nodes:
+            for node in top.walk():
+                if isinstance(node, IncludeNode) and isinstance(node._expr, ValueExpr):
+                    result.append(str(node._expr._value))
+
+        return result
+
+    def _bind(self, env):
+        """ Return a copy of the template that renders in another environment.
+            The parsed nodes are shared with this template.
+        """
+        result = copy.copy(self)
+        result._env = env
+        return result
+
+    def render(self, renderer, context=None, retvar=None, finish=True):
+        """ Render the template.  Unless finish is false, the renderer's
+            finish method, if it has one, is called when done.
+        """
+        self._render(self._env, renderer, context, retvar)
+        if finish and hasattr(renderer, "finish"):
+            renderer.finish()
+
+    def _render(self, env, renderer, context=None, retvar=None):
+        """ Render the template in a given environment. """
+        toplevel = len(env._scope_stack) == 1
+        metrics = env._metrics
+        metrics._enter(env)
+        start = perf_counter()
+
         scope = env._push_scope(True)
         try:
             if not context is None:
@@ -75,11 +134,116 @@ class Template(object):
             # set certain variables
             scope._template["__filename__"] = self._filename
 
-            self._nodes.render(renderer)
+            if self._memoize is None:
+                self._render_nodes(env, renderer)
+            else:
+                key = self._memo_key(env)
+                entry = self._memo_get(key)
+                if entry is None:
+                    renderer.push_capture()
+                    self._render_nodes(env, renderer)
+                    entry = self._memo_store(key, renderer.pop_capture(), scope)
+                self._memo_replay(entry, renderer, scope)
         finally:
             env._pop_scope()
+            if toplevel and env._memo:
+                env._memo.clear()
+            metrics._leave(env, self._filename, perf_counter() - start)
 
         # Set up any return values:
         if retvar:
             env.set(retvar, scope._template.get(":return:", {}))
 
+    def _render_nodes(self, env, renderer):
+        """ Render the nodes of the template. """
+        if env._iterative:
+            render_iterative(env, self._nodes, renderer)
+        else:
+            for node in self._nodes:
+                node.render(env, renderer)
+
+    def _memo_key(self, env):
+        """ Return the key of the memoized output for the current values, or
+            None if the values can not be used as a key.
+        """
+        values = []
+        for var in self._memoize:
+            try:
+                values.append(env.get(var))
+            except KeyError:
+                values.append(_MISSING)
+
+        key = _typed(tuple(values))
+
+        try:
+            hash(key)
+        except TypeError:
+            return None
+
+        return key
+
+    def _memo_get(self, key):
+        """ Return the memoized (output, return) entry for a key or None. """
+        if key is None:
+            return None
+
+        # Move the entry to the end, as OrderedDict.move_to_end does not exist
+        # on Python 2
+        with self._memo_lock:
+            entry = self._memo_cache.pop(key, None)
+            if entry is not None:
+                self._memo_cache[key] = entry
+
+        return entry
+
+    def _memo_store(self, key, output, scope):
+        """ Memoize the output and return values of a render. """
+        result = scope._template.get(":return:")
+        entry = (output, dict(result) if result is not None else None)
+
+        if key is not None:
+            cache = self._memo_cache
+            with self._memo_lock:
+                cache[key] = entry
+                if len(cache) > self.MEMOIZE_SIZE:
+                    cache.popitem(False)
+
+        return entry
+
+    def _memo_replay(self, entry, renderer, scope):
+        """ Render memoized output and restore the return values. """
+        (output, result) = entry
+        renderer.render(output)
+        if result is not None:
+            scope._template[":return:"] = dict(result)
+
+    def _iter(self, env, renderer, context=None, retvar=None):
+        """ Yield the template body for render_iterative. """
+        metrics = env._metrics
+        metrics._enter(env)
+        start = perf_counter()
+
+        scope = env._push_scope(True)
+        try:
+            if not context is None:
+                scope._local.update(context)
+
+            scope._template["__filename__"] = self._filename
+
+            if self._memoize is None:
+                yield (self._nodes, renderer)
+            else:
+                key = self._memo_key(env)
+                entry = self._memo_get(key)
+                if entry is None:
+                    renderer.push_capture()
+                    yield (self._nodes, renderer)
+                    entry = self._memo_store(key, renderer.pop_capture(), scope)
+                self._memo_replay(entry, renderer, scope)
+        finally:
+            env._pop_scope()
+            metrics._leave(env, self._filename, perf_counter() - start)
+
+        if retvar:
+            env.set(retvar, scope._template.get(":return:", {}))
+
@@ -8,8 +8,19 @@ __license__     = "Apache License 2.0"
 import os
 import json
 import glob
+import gc
+import io
+import sys
+import subprocess
 
-from ...template import UnrestrictedLoader, SearchPathLoader, Environment, StdLib, StringRenderer
+import pytest
+
+from ...template import UnrestrictedLoader, SearchPathLoader, MemoryLoader, Environment, StdLib, StringRenderer
+from ...template import StreamRenderer, BytesRenderer
+from ...template import precompile, PrecompileError, LazyValue, TemplateError
+from ...template import save_code_cache, load_code_cache, IncrementalRender
+from ...template.lib import memoize
+from ...template.lib.collection import CollectionLib
 
 DATADIR = os.path.join(os.path.dirname(__file__), "template_data")
 
@@ -29,6 +40,14 @@ def test_compare_search_path_loader():
 
     do_test_compare(env, True)
 
+def test_compare_iterative():
+    loader = SearchPathLoader(DATADIR)
+    env = Environment({"lib": StdLib() }, loader=loader)
+    env.enable_code()
+    env.enable_iterative()
+
+    do_test_compare(env, True)
+
 def do_test_compare(env, search_path_loader):
     """ Run tests by applying template to input and comparing output. """
 
@@ -107,3 +126,674 @@ def test_search_path():
 
 
 
+
+def test_precompile(tmpdir):
+    """ Test precompiling a tree of templates. """
+    paths = [
+        os.path.join(DATADIR, "searchpath/1"),
+        os.path.join(DATADIR, "searchpath/2"),
+        os.path.join(DATADIR, "searchpath/3")
+    ]
+
+    env = Environment({"lib": StdLib()}, loader=SearchPathLoader(paths))
+    names = precompile(paths, workers=2, env=env)
+    assert names == [
+        "/main.tmpl", "/next.tmpl", "/sub/subitem.tmpl", "/sub/subitem2.tmpl",
+        "/sub/subitem3.tmpl"
+    ]
+    assert env.load_file("/main.tmpl") is env.load_file("/main.tmpl")
+
+    tmpdir.join("good.tmpl").write("{{ value }}")
+    tmpdir.join("bad1.tmpl").write("Line 1\n{% if value %}")
+    tmpdir.mkdir("sub").join("bad2.tmpl").write("\n\n{% endfor %}")
+
+    try:
+        precompile(str(tmpdir), workers=2)
+        assert False
+    except PrecompileError as e:
+        errors = [(error.filename, error.line) for error in e.errors]
+        assert errors == [("/bad1.tmpl", 2), ("/sub/bad2.tmpl", 3)]
+
+def test_preload():
+    """ Test preloading templates reachable from a root template. """
+    paths = [
+        os.path.join(DATADIR, "searchpath/1"),
+        os.path.join(DATADIR, "searchpath/2"),
+        os.path.join(DATADIR, "searchpath/3")
+    ]
+
+    env = Environment({"lib": StdLib()}, loader=SearchPathLoader(paths))
+    try:
+        loaded = env.preload(["/main.tmpl"], freeze=True)
+    finally:
+        # Leave the collector as it was for the rest of the tests
+        if hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+
+    assert [(tmpl._filename, tmpl._private["search_index"]) for tmpl in loaded] == [
+        ("/main.tmpl", 0),
+        ("/sub/subitem.tmpl", 0),
+        ("/sub/subitem2.tmpl", 1),
+        ("/next.tmpl", 2),
+        ("/sub/subitem3.tmpl", 0),
+        ("/sub/subitem3.tmpl", 1),
+        ("/sub/subitem3.tmpl", 2)
+    ]
+    assert env.load_file("/main.tmpl") is loaded[0]
+
+def test_pure_folding():
+    """ Test calls to pure functions with literal arguments are folded. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{{ lib.path.join("a", "b") }} {{ lib.string.split(",", "a,b") }} {{ lib.add(value, 1) }}'
+    )
+
+    env = Environment({"lib": StdLib()}, loader=loader)
+    tmpl = env.load_file("main.tmpl")
+
+    assert [node._expr._folded is not None for node in tmpl._nodes if type(node).__name__ == "EmitNode"] == [
+        True, False, False
+    ]
+
+    rndr = StringRenderer()
+    tmpl.render(rndr, {"value": 1})
+    assert rndr.get() == os.path.join("a", "b") + " ['a', 'b'] 2"
+
+def test_pure_folding_shadowed():
+    """ Test folded calls still call a shadowing library. """
+
+    class Other(object):
+        def add(self, a, b):
+            return "other"
+
+    loader = MemoryLoader()
+    loader.add_template("/call.tmpl", "{{ lib.add(1, 2) }}")
+    loader.add_template("/set.tmpl", "{% set lib = other %}{{ lib.add(1, 2) }}")
+    loader.add_template("/include.tmpl", '{% include "/call.tmpl" with lib = other %}')
+
+    env = Environment({"lib": StdLib(), "other": Other()}, loader=loader)
+
+    for (name, expected) in (("call.tmpl", "3"), ("set.tmpl", "other"), ("include.tmpl", "other")):
+        rndr = StringRenderer()
+        env.load_file(name).render(rndr)
+        assert rndr.get() == expected
+
+    rndr = StringRenderer()
+    fork = env.fork({"lib": Other()})
+    fork.load_file("call.tmpl").render(rndr)
+    assert rndr.get() == "other"
+
+def test_memoize():
+    """ Test memoizing library calls during a render. """
+
+    class DataLib(object):
+        def __init__(self):
+            self.calls = 0
+
+        @memoize
+        def lookup(self, value):
+            self.calls += 1
+            return value * 2
+
+        @memoize
+        def size(self, value):
+            self.calls += 1
+            return len(value)
+
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        "{% for i in [1, 2, 1, 2, 1] %}{{ data.lookup(i) }}{{ data.size(items) }}{% endfor %}"
+    )
+
+    data = DataLib()
+    env = Environment({"data": data, "items": [1, 2, 3]}, loader=loader)
+    env.enable_memoize()
+
+    tmpl = env.load_file("/main.tmpl")
+    for i in range(2):
+        rndr = StringRenderer()
+        tmpl.render(rndr)
+        assert rndr.get() == "2343234323"
+
+    assert data.calls == 6
+    assert env.memoize_stats() == {"hits": 14, "misses": 6}
+
+def test_lazy_value():
+    """ Test lazy values are only computed when used. """
+    calls = []
+
+    def compute(name, value):
+        def fn():
+            calls.append(name)
+            return value
+        return LazyValue(fn)
+
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        "{% if show %}{{ unused }}{% endif %}{{ total }} {{ total }} {{ user.name }}"
+    )
+
+    env = Environment(loader=loader)
+    tmpl = env.load_file("/main.tmpl")
+
+    rndr = StringRenderer()
+    tmpl.render(rndr, {
+        "show": False,
+        "unused": compute("unused", 0),
+        "total": compute("total", 42),
+        "user": {"name": compute("name", "Bob")}
+    })
+
+    assert rndr.get() == "42 42 Bob"
+    assert calls == ["total", "name"]
+
+def test_fork():
+    """ Test forked environments share templates but not globals. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{% global counter = name %}{{ site }}:{{ name }}{% include "inc.tmpl" %}'
+    )
+    loader.add_template("/inc.tmpl", ":{{ counter }}")
+
+    env = Environment({"site": "Site", "lib": StdLib()}, loader=loader)
+    base = env.load_file("/main.tmpl")
+
+    results = []
+    for name in ("Bob", "Susan"):
+        fork = env.fork({"name": name})
+        tmpl = fork.load_file("/main.tmpl")
+        assert tmpl._nodes is base._nodes
+
+        rndr = StringRenderer()
+        tmpl.render(rndr)
+        results.append(rndr.get())
+
+    assert results == ["Site:Bob:Bob", "Site:Susan:Susan"]
+    assert not "counter" in env._scope._local
+    assert not "name" in env._scope._local
+
+def test_iterative_depth():
+    """ Test recursive includes deeper than the recursion limit. """
+    loader = MemoryLoader()
+    loader.add_template("/tree.tmpl",
+        '{% if depth > 0 %}<{% include "tree.tmpl" with depth = depth - 1 %}>{% endif %}'
+    )
+
+    env = Environment(loader=loader)
+    env.enable_iterative()
+
+    rndr = StringRenderer()
+    env.load_file("/tree.tmpl").render(rndr, {"depth": 3000})
+    assert rndr.get() == "<" * 3000 + ">" * 3000
+
+def test_section_spill():
+    """ Test sections spilled to temporary files. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{% section "body" %}{% for i in items %}{{ i }}\u00e9,{% endfor %}{% endsection %}'
+        '[{% use "body" %}]'
+    )
+
+    env = Environment(loader=loader)
+    items = list(range(5000))
+    expected = "".join("{0}\u00e9,".format(i) for i in items)
+
+    rndr = StringRenderer(spill_size=100)
+    env.load_file("/main.tmpl").render(rndr, {"items": items}, finish=False)
+
+    section = rndr._sections["body"]
+    assert section._file is not None
+    assert rndr.get_section("body") == expected
+    assert rndr.get() == "[" + expected + "]"
+    assert section._file.closed
+
+def test_deferred_section():
+    """ Test using a section before content is added to it. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '<{% use "head" defer %}>'
+        '{% for i in items %}{% section "head" %}{{ i }};{% endsection %}{{ i }}{% endfor %}'
+    )
+
+    env = Environment(loader=loader)
+    tmpl = env.load_file("/main.tmpl")
+    expected = "<1;2;3;>123"
+
+    rndr = StringRenderer()
+    tmpl.render(rndr, {"items": [1, 2, 3]})
+    assert rndr.get() == expected
+
+    class Stream(object):
+        def __init__(self):
+            self.parts = []
+
+        def write(self, text):
+            self.parts.append(text)
+
+    stream = Stream()
+    rndr = StreamRenderer(stream)
+    tmpl.render(rndr, {"items": [1, 2, 3]})
+    assert "".join(stream.parts) == expected
+
+    # Several templates can be rendered before finishing
+    loader.add_template("/more.tmpl", '{% section "head" %}4;{% endsection %}')
+    rndr = StringRenderer()
+    tmpl.render(rndr, {"items": [1, 2, 3]}, finish=False)
+    env.load_file("/more.tmpl").render(rndr, finish=False)
+    rndr.finish()
+    assert rndr.get() == "<1;2;3;4;>123"
+
+def test_bytes_renderer():
+    """ Test rendering encoded output to a binary sink. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '<{% use "head" defer %}>'
+        '{% for i in items %}{% section "head" %}{{ i }};{% endsection %}\u00e9{{ i }}{% endfor %}'
+    )
+
+    env = Environment(loader=loader)
+    tmpl = env.load_file("/main.tmpl")
+    items = list(range(100))
+
+    rndr = StringRenderer()
+    tmpl.render(rndr, {"items": items})
+    expected = rndr.get().encode("utf-8")
+
+    for size in (1, 16, 65536):
+        stream = io.BytesIO()
+        rndr = BytesRenderer(stream, buffer_size=size)
+        tmpl.render(rndr, {"items": items})
+        assert stream.getvalue() == expected
+
+    # Sinks may keep what they are given
+    class Sink(object):
+        def __init__(self):
+            self.parts = []
+
+        def write(self, data):
+            self.parts.append(data)
+
+    sink = Sink()
+    tmpl.render(BytesRenderer(sink, buffer_size=16), {"items": items})
+    assert b"".join(sink.parts) == expected
+
+def test_autoescape():
+    """ Test autoescaping of emitted values. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{{ value }}{% var v %}<b>{{ value }}</b>{% endvar %}{{ v }}'
+        '{{ lib.html.esc(value) }}{{ lib.html.safe("<i>") }}{{ "<&>" }}'
+        '{% no_autoescape %}{{ value }}'
+    )
+
+    env = Environment({"lib": StdLib()}, loader=loader)
+    env.enable_autoescape()
+
+    rndr = StringRenderer()
+    env.load_file("/main.tmpl").render(rndr, {"value": "<a href='x'>"})
+    assert rndr.get() == (
+        "&lt;a href=&#x27;x&#x27;&gt;"
+        "<b>&lt;a href=&#x27;x&#x27;&gt;</b>"
+        "&lt;a href='x'&gt;<i>&lt;&amp;&gt;"
+        "<a href='x'>"
+    )
+
+def test_for_loop_info():
+    """ Test lazy iteration and loop information in for loops. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{% for i in values loop info %}'
+        '{% if info.first %}[{% endif %}{{ info.index }}:{{ i }}/{{ info.length }}'
+        '{% if info.last %}]{% else %},{% endif %}'
+        '{% else %}empty{% endfor %}'
+    )
+
+    env = Environment(loader=loader)
+    tmpl = env.load_file("/main.tmpl")
+
+    rndr = StringRenderer()
+    tmpl.render(rndr, {"values": (i for i in "abc")})
+    assert rndr.get() == "[0:a/3,1:b/3,2:c/3]"
+
+    for value in (None, False, 0, [], iter([])):
+        rndr = StringRenderer()
+        tmpl.render(rndr, {"values": value})
+        assert rndr.get() == "empty"
+
+    # Iterables such as query results are only iterated once
+    class Query(object):
+        def __init__(self):
+            self.runs = 0
+
+        def __iter__(self):
+            self.runs += 1
+            return iter("ab")
+
+    query = Query()
+    rndr = StringRenderer()
+    tmpl.render(rndr, {"values": query})
+    assert rndr.get() == "[0:a/2,1:b/2]"
+    assert query.runs == 1
+
+def test_lazy_helpers():
+    """ Test the lazy sequence helpers of the standard library. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{% for i in lib.seq(0, 10, 3) %}{{ i }}{% endfor %};'
+        '{% for i in lib.list.reversed(lib.seq(0, 3)) %}{{ i }}{% endfor %};'
+        '{% for i in lib.list.islice(lib.seq(0, 1000000000), 2, 5) %}{{ i }}{% endfor %};'
+        '{% for c in lib.list.chunks("abcde", 2) %}{{ lib.string.join("", c) }},{% endfor %};'
+        '{% for w in lib.list.window("abcd", 3) %}{{ lib.string.join("", w) }},{% endfor %}'
+    )
+
+    env = Environment({"lib": StdLib()}, loader=loader)
+
+    rndr = StringRenderer()
+    env.load_file("/main.tmpl").render(rndr)
+    assert rndr.get() == "0369;210;234;ab,cd,e,;abc,bcd,"
+
+def test_collection_lib():
+    """ Test the collection library. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{% import coll="mrbaviirc.template.collection" %}'
+        '{{ coll.sum(rows, "item.price") }};'
+        '{% set top = coll.max(rows, "item.price") %}{{ top.name }};'
+        '{% for row in coll.sorted(rows, "name") %}{{ row.name }}{% endfor %};'
+        '{% for group in coll.groupby(rows, "kind") %}'
+        '{{ group.key }}={{ lib.count(group.values) }},{% endfor %};'
+        '{{ lib.count(coll.unique(rows, "kind")) }};'
+        '{% for row in coll.topk(rows, 2, "item.price") %}{{ row.name }}{% endfor %};'
+        '{{ coll.min([3, 1, 2]) }};{{ coll.max([]) }}'
+    )
+
+    rows = [
+        {"name": "b", "kind": "x", "item": {"price": 3}},
+        {"name": "a", "kind": "y", "item": {"price": 5}},
+        {"name": "c", "kind": "x", "item": {"price": 1}}
+    ]
+
+    env = Environment({"lib": StdLib()}, loader=loader)
+
+    rndr = StringRenderer()
+    env.load_file("/main.tmpl").render(rndr, {"rows": rows})
+    assert rndr.get() == "9;a;abc;x=2,y=1,;2;ab;1;None"
+
+    # Lists returned for literal arguments are new on every render
+    loader.add_template("/append.tmpl",
+        '{% set s = coll.sorted([3, 1]) %}{% do lib.list.append(s, 9) %}{{ s }}'
+    )
+    env = Environment({"lib": StdLib(), "coll": CollectionLib()}, loader=loader)
+    for i in range(2):
+        rndr = StringRenderer()
+        env.load_file("/append.tmpl").render(rndr)
+        assert rndr.get() == "[1, 3, 9]"
+
+def test_import_registry():
+    """ Test libraries are shared between environments. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{% import s="mrbaviirc.template.stdlib", c="collection" %}'
+        '{{ s.str(1) }}{{ c.sum(values) }}'
+    )
+
+    importers = {"collection": "mrbaviirc.template.lib.collection:CollectionLib"}
+    env1 = Environment(loader=loader, importers=importers)
+    env2 = Environment(loader=loader, importers=importers)
+
+    assert env1.load_import("collection") is env2.load_import("collection")
+    assert env1.load_import("mrbaviirc.template.stdlib") is env2.load_import("mrbaviirc.template.stdlib")
+
+    # Other callables give each environment its own library
+    importers = {"own": lambda: StdLib()}
+    env3 = Environment(loader=loader, importers=importers)
+    env4 = Environment(loader=loader, importers=importers)
+    assert env3.load_import("own") is env3.load_import("own")
+    assert env3.load_import("own") is not env4.load_import("own")
+
+    rndr = StringRenderer()
+    env1.load_file("/main.tmpl").render(rndr, {"values": [1, 2]})
+    env1.load_file("/main.tmpl").render(rndr, {"values": [3]})
+    assert rndr.get() == "1313"
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="modules are imported eagerly before Python 3.7")
+def test_lazy_import():
+    """ Test importing the package does not import the whole engine. """
+    code = (
+        "import sys\n"
+        "from mrbaviirc.template import MemoryLoader, Error\n"
+        "print(' '.join(sorted(sys.modules)))\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=root)
+    modules = output.decode("utf-8").split()
+
+    assert "mrbaviirc.template.loaders" in modules
+    for name in ("parser", "nodes", "env", "renderers", "lib", "lib.stdlib"):
+        assert not "mrbaviirc.template." + name in modules
+
+def test_code_cache(tmpdir):
+    """ Test code blocks are compiled once and can be saved. """
+    source = '{% code return r with x=value %}\ny = x * 2\n{% endcode %}{{ r.y }}'
+    loader = MemoryLoader()
+    loader.add_template("/a.tmpl", source)
+    loader.add_template("/b.tmpl", source)
+
+    env = Environment(loader=loader)
+    env.enable_code()
+
+    results = []
+    for name in ("/a.tmpl", "/b.tmpl"):
+        rndr = StringRenderer()
+        tmpl = env.load_file(name)
+        tmpl.render(rndr, {"value": 21})
+        results.append((rndr.get(), tmpl._nodes[0]._code.__code__))
+
+    assert results[0][0] == results[1][0] == "42"
+    assert results[0][1] is results[1][1]
+
+    loader.add_template("/module.tmpl",
+        '{% code return r %}\n'
+        'from os.path import *\n'
+        'x = 1\n'
+        'def bump():\n'
+        '    global x\n'
+        '    x = 2\n'
+        'bump()\n'
+        'y = join("a", "b")\n'
+        '{% endcode %}{{ r.x }} {{ r.y }}'
+    )
+    rndr = StringRenderer()
+    env.load_file("/module.tmpl").render(rndr)
+    assert rndr.get() == "2 " + os.path.join("a", "b")
+
+    loader.add_template("/builtin.tmpl",
+        '{% code return r with x=value %}\nn = len(x)\nlen = 5\n{% endcode %}{{ r.n }}'
+    )
+    rndr = StringRenderer()
+    env.load_file("/builtin.tmpl").render(rndr, {"value": "abc"})
+    assert rndr.get() == "3"
+
+    loader.add_template("/return.tmpl", '{% code %}\nreturn 1\n{% endcode %}')
+    with pytest.raises(TemplateError):
+        env.load_file("/return.tmpl").render(StringRenderer())
+
+    filename = str(tmpdir.join("code.cache"))
+    save_code_cache(filename)
+    assert load_code_cache(filename)
+
+def test_capture_sections():
+    """ Test sections used and written inside captured output. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{% section "s" %}a{% endsection %}'
+        '{% for i in items %}{% var v %}[{% use "s" %}{% section "s" %}{{ i }}{% endsection %}]{% endvar %}{{ v }}{% endfor %}'
+    )
+
+    env = Environment(loader=loader)
+
+    rndr = StringRenderer()
+    env.load_file("/main.tmpl").render(rndr, {"items": [1, 2]})
+    assert rndr.get() == "[a][a1]"
+    assert rndr.get_section("s") == "a12"
+
+def test_memoize_template():
+    """ Test memoizing the output of an included template. """
+    calls = []
+    def label(name):
+        calls.append(name)
+        return name.upper()
+
+    for iterative in (False, True):
+        loader = MemoryLoader()
+        loader.add_template("/widget.tmpl",
+            '{% memoize name %}{% set text = label(name) %}<{{ text }}>{% return text=text %}'
+        )
+        loader.add_template("/main.tmpl",
+            '{% for name in names %}'
+            '{% include "widget.tmpl" return r with name=name %}{{ r.text }};'
+            '{% endfor %}'
+        )
+        loader.add_template("/bad.tmpl", '{% memoize name %}{% section "s" %}{% endsection %}')
+        loader.add_template("/value.tmpl", '{% memoize v %}{{ v }}')
+        loader.add_template("/types.tmpl",
+            '{% include "value.tmpl" with v=1 %}|{% include "value.tmpl" with v=v %}'
+        )
+        loader.add_template("/novars.tmpl", '{% memoize %}{{ v }}')
+
+        del calls[:]
+        env = Environment({"label": label}, loader=loader)
+        env.enable_iterative(iterative)
+
+        rndr = StringRenderer()
+        env.load_file("/main.tmpl").render(rndr, {"names": ["a", "b", "a", "a"]})
+        assert rndr.get() == "<A>A;<B>B;<A>A;<A>A;"
+        assert calls == ["a", "b"]
+
+        rndr = StringRenderer()
+        env.load_file("/types.tmpl").render(rndr, {"v": True})
+        assert rndr.get() == "1|True"
+
+        rndr = StringRenderer()
+        env.load_file("/value.tmpl").render(rndr, {"v": (1,)})
+        env.load_file("/value.tmpl").render(rndr, {"v": (True,)})
+        assert rndr.get() == "(1,)(True,)"
+
+    with pytest.raises(TemplateError):
+        env.load_file("/bad.tmpl")
+
+    with pytest.raises(TemplateError):
+        env.load_file("/novars.tmpl")
+
+def test_incremental_render():
+    """ Test rerendering only the blocks affected by changed values. """
+    calls = []
+    def count(name, value):
+        calls.append(name)
+        return value
+
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl",
+        '{% set total = count("a", a) + 1 %}'
+        '[{{ count("b", b) }}]'
+        '{% for i in items %}{{ i }}{% endfor %}'
+        '{% section "s" %}{{ total }}{% endsection %}'
+        '({{ count("total", total) }})'
+    )
+
+    env = Environment({"count": count}, loader=loader)
+    inc = IncrementalRender(env.load_file("/main.tmpl"))
+
+    def render(context, changed=None):
+        del calls[:]
+        rndr = StringRenderer()
+        inc.render(rndr, context, changed)
+        return (rndr.get(), rndr.get_section("s"), sorted(calls))
+
+    items = [1, 2]
+    assert render({"a": 1, "b": 2, "items": items}) == ("[2]12(2)", "2", ["a", "b", "total"])
+    assert render({"a": 1, "b": 3, "items": items}) == ("[3]12(2)", "2", ["b"])
+    assert render({"a": 5, "b": 3, "items": items}) == ("[3]12(6)", "6", ["a", "total"])
+
+    items.append(3)
+    assert render({"a": 5, "b": 3, "items": items}) == ("[3]12(6)", "6", [])
+    assert render({"a": 5, "b": 3, "items": items}, ["items"]) == ("[3]123(6)", "6", [])
+
+    # Names a block no longer sets are changed as well
+    loader.add_template("/cond.tmpl", '{% if a %}{% set z = 1 %}{% endif %}[{{ z }}]')
+    inc = IncrementalRender(env.load_file("/cond.tmpl"))
+    assert render({"a": True, "z": 0})[0] == "[1]"
+    assert render({"a": False, "z": 0})[0] == "[0]"
+
+def test_incremental_render_isolated():
+    """ Test other renders of the environment are not recorded. """
+    calls = []
+    def nested(value):
+        calls.append(value)
+        assert "get" not in vars(env)
+        rndr = StringRenderer()
+        env.load_file("/other.tmpl").render(rndr, {"x": value})
+        return rndr.get()
+
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl", '[{{ nested(n) }}]{% include "/part.tmpl" %}')
+    loader.add_template("/other.tmpl", '{{ x }}')
+    loader.add_template("/part.tmpl", '{% section "s" %}{{ n }}{% endsection %}')
+
+    env = Environment({"nested": nested}, loader=loader)
+    inc = IncrementalRender(env.load_file("/main.tmpl"))
+
+    for i in range(2):
+        rndr = StringRenderer()
+        inc.render(rndr, {"n": 1}, ["x"] if i else None)
+        assert (rndr.get(), rndr.get_section("s")) == ("[1]", "1")
+
+    assert calls == [1]
+
+def test_metrics(tmpdir):
+    """ Test the load and render metrics. """
+    loader = MemoryLoader()
+    loader.add_template("/main.tmpl", '{% include "part.tmpl" %}{% include "part.tmpl" %}')
+    loader.add_template("/part.tmpl", 'x')
+
+    env = Environment(loader=loader)
+    for i in range(3):
+        rndr = StringRenderer()
+        env.load_file("/main.tmpl").render(rndr)
+
+    loads = loader.metrics().snapshot()
+    assert loads["parses"] == 2
+    assert loads["cache_misses"] == 2
+    assert loads["cache_hits"] == 7
+
+    renders = env.metrics().snapshot()
+    assert renders["renders"]["/main.tmpl"]["count"] == 3
+    assert renders["renders"]["/part.tmpl"]["count"] == 6
+    assert renders["max_include_depth"] == 2
+
+    filename = str(tmpdir.join("metrics.prom"))
+    env.metrics().write_prometheus(filename)
+    with open(filename) as handle:
+        text = handle.read()
+    assert 'mrbaviirc_template_render_seconds_count{template="/part.tmpl"} 6' in text
+    assert 'mrbaviirc_template_render_seconds_bucket{template="/part.tmpl",le="+Inf"} 6' in text
+
+    inc = IncrementalRender(env.load_file("/main.tmpl"))
+    for i in range(2):
+        inc.render(StringRenderer())
+
+    renders = env.metrics().snapshot()
+    assert renders["renders"]["/main.tmpl"]["count"] == 5
+    assert renders["renders"]["/part.tmpl"]["count"] == 8
+
+    # Renders of other forks at the same time do not add to the depth
+    def other():
+        rndr = StringRenderer()
+        base.fork().load_file("/part.tmpl").render(rndr)
+        return rndr.get()
+
+    base = Environment({"other": other}, loader=loader)
+    loader.add_template("/other.tmpl", '{{ other() }}')
+    rndr = StringRenderer()
+    base.fork().load_file("/other.tmpl").render(rndr)
+    assert base.metrics().snapshot()["max_include_depth"] == 1